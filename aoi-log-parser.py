@@ -7,333 +7,601 @@ OUT_FILE = r".\parsing-log.txt"  # log file path
 
 # Imports
 
+import argparse
+import json
 import os
 import re
-from datetime import datetime
+import struct
+import sys
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from multiprocessing import freeze_support
 from typing import *
 
+import numpy as np
 import pyodbc
 
+import aoilog
+from aoilog import (
+    RECORD_EXT,
+    CircuitData,
+    LotData,
+    bcolors,
+    layer_prog,
+    log,
+    pack_lot_data,
+    parse_log_file,
+    read_file,
+    unpack_lot_data,
+)
+from dbpool import ConnectionPool, build_connection_string, is_transient
+
+aoilog.LOG_FILE = OUT_FILE if DEV else None
+
 # Globals
-DATE_FORMAT = "%m/%d/%Y"
 SM_INI_PATH = r"\\10.225.43.45\prod-critical\LTCC\DSP\DSP_Print\dsp_print_sdd.ini"
 DATA_PATH = (
     r"\\10.225.43.45\prod-critical\LTCC\DSP\DSP_Print\BatchLogs"  # data folder path
 )
-cursor = pyodbc.Cursor
+db_pool = ConnectionPool(
+    build_connection_string(r"secret", "LTCC_PRO", "dspuser", "dspus3r"), log=log
+)
 existing_lot_data_keys = set()  # global set of lots that we have already
+PREFETCH_WORKERS = 4  # threads reading log files ahead of the parser
+PREFETCH_MAX_BYTES = 32 * 1024 * 1024  # max bytes of file reads in flight
+PREFETCH_MAX_FILES = 64  # max files read ahead of the parser
+BATCH_STALE_SECONDS = 24 * 60 * 60  # close batches left unfinished this long by a dead run
+# folder of the script, or of the exe when built with pyinstaller, so a scheduled task
+# finds its spool and state files whatever its working directory is
+APP_DIR = os.path.dirname(
+    os.path.abspath(sys.executable if getattr(sys, "frozen", False) else __file__)
+)
+BACKFILL_STATE_PATH = os.path.join(APP_DIR, "backfill-state.json")  # resume file for backfill runs
+BACKFILL_COMMIT_FILES = 50  # files staged per commit during backfill
+STAGE_SUFFIX = "_stage"  # staging copies of the live tables used by backfill
+SPOOL_DIR = os.path.join(APP_DIR, "spool")  # parsed lots waiting for upload
+SPOOL_OPEN_EXT = ".open"  # segment still being written
+SPOOL_SEGMENT_EXT = ".seg"  # sealed segment, ready to upload
+SPOOL_BAD_EXT = ".bad"  # segment the database rejected, kept for a look
+SPOOL_SEGMENT_BYTES = 8 * 1024 * 1024  # seal a segment after this many bytes
+SPOOL_MAX_FAILED_SEGMENTS = 3  # stop the upload after this many failed segments in a row
+LOT_KEYS_CACHE_PATH = os.path.join(SPOOL_DIR, "lot-keys.json")  # used if the DB is down
+SCHEDULE_ORDER = "newest"  # parse and upload "newest" or "oldest" files first
+PRIORITY_LAYERS: List[str] = []  # layers handled before all others, e.g. ["A2"]
+RUN_TIME_BUDGET_SECONDS = 45 * 60  # stop starting new work after this, None for no limit
+PARSE_BUDGET_SHARE = 0.5  # share of the time budget parsing may use
+RUN_ROW_BUDGET = 500000  # max circuit rows per run, None for no limit
+KEY_FETCH_ROWS = 100000  # rows per fetch when loading existing circuit keys
+KEY_INDEX_BLOOM = False  # put a Bloom filter in front of the circuit key index
+BLOOM_BITS_PER_KEY = 10  # ~1% false positives with 4 hashes
+BLOOM_MULTIPLIERS = [  # one odd 64-bit multiplier per hash
+    0x9E3779B97F4A7C15,
+    0xC2B2AE3D27D4EB4F,
+    0x165667B19E3779F9,
+    0xD6E8FEB86659FD93,
+]
 
 # precompile regular expressions
-layer_prog = re.compile(r"_([A-Z]\d+)_")
-prog = re.compile(r"\[(.*?)\](.*?)(?=\n\[|$)")
-circuit_prog = re.compile(
-    r"ES\s+(\d+)\s+FC(?:\s+(\d+))?\s+Length\s+(\d+\.\d+)\s+Breadth\s+(\d+\.\d+)\s+Area\s+(\d+\.\d+)"
-)
 lot_prog = re.compile(r"Lot=(\d+)")
 
+# spool record header, the parsed record layout is in aoilog.py
+spool_record_struct = struct.Struct("<II")  # record length, CRC32
+
+# packed circuit key layout, 64 bits from the top: lot, substrate, circuit + 1, layer
+KEY_LOT_BITS = 27
+KEY_SUBSTRATE_BITS = 12
+KEY_CIRCUIT_BITS = 16
+KEY_LAYER_BITS = 9
+
+# defect summary histogram bin edges (lower bounds, last bin is open-ended)
+LENGTH_BINS = [0, 50, 100, 200, 500, 1000]
+AREA_BINS = [0, 1000, 5000, 10000, 50000, 100000]
+
+# tables owned by the parser, created on startup if missing
+# lot-keyed tables copy their key column types from circuit_data with SELECT INTO
+TABLE_DDL = {
+    "LTCC_PRO.dspg.lot_summary": [
+        """
+        SELECT TOP 0 lotNum, layer, status,
+            CAST(0 AS INT) AS circuitCnt, CAST(0 AS INT) AS stopCnt
+        INTO LTCC_PRO.dspg.lot_summary
+        FROM LTCC_PRO.dspg.circuit_data
+        """,
+        "CREATE CLUSTERED INDEX ix_lot_summary_lot ON LTCC_PRO.dspg.lot_summary (lotNum, layer)",
+    ],
+    "LTCC_PRO.dspg.substrate_summary": [
+        """
+        SELECT TOP 0 lotNum, layer, substrateNum,
+            CAST(0 AS INT) AS defectCnt, CAST(0 AS INT) AS stopCnt
+        INTO LTCC_PRO.dspg.substrate_summary
+        FROM LTCC_PRO.dspg.circuit_data
+        """,
+        "CREATE CLUSTERED INDEX ix_substrate_summary_lot ON LTCC_PRO.dspg.substrate_summary (lotNum, layer)",
+    ],
+    "LTCC_PRO.dspg.defect_histogram": [
+        """
+        SELECT TOP 0 lotNum, layer,
+            CAST('' AS VARCHAR(10)) AS metric, CAST(0 AS FLOAT) AS binStart,
+            CAST(NULL AS FLOAT) AS binEnd, CAST(0 AS INT) AS circuitCnt
+        INTO LTCC_PRO.dspg.defect_histogram
+        FROM LTCC_PRO.dspg.circuit_data
+        """,
+        "CREATE CLUSTERED INDEX ix_defect_histogram_lot ON LTCC_PRO.dspg.defect_histogram (lotNum, layer)",
+    ],
+    "LTCC_PRO.dspg.ingest_batch": [
+        """
+        CREATE TABLE LTCC_PRO.dspg.ingest_batch (
+            batchId BIGINT IDENTITY(1, 1) PRIMARY KEY,
+            source VARCHAR(20) NOT NULL,
+            startedAt DATETIME2 NOT NULL,
+            finishedAt DATETIME2 NULL,
+            changeCnt INT NULL
+        )
+        """,
+    ],
+    # key columns copied from lot_data and circuit_data so their types always match,
+    # the outer joins make machine, substrateNum and circuitNum nullable
+    "LTCC_PRO.dspg.change_feed": [
+        """
+        SELECT TOP 0
+            ISNULL(CAST(0 AS BIGINT), 0) AS batchId,
+            ISNULL(CAST('' AS VARCHAR(20)), '') AS tableName,
+            ISNULL(CAST('' AS VARCHAR(20)), '') AS changeType,
+            l.lotNum, m.machine, l.layer, c.substrateNum, c.circuitNum
+        INTO LTCC_PRO.dspg.change_feed
+        FROM LTCC_PRO.dspg.lot_data l
+        LEFT JOIN LTCC_PRO.dspg.lot_data m ON 1 = 0
+        LEFT JOIN LTCC_PRO.dspg.circuit_data c ON 1 = 0
+        """,
+        "CREATE CLUSTERED INDEX ix_change_feed_batchId ON LTCC_PRO.dspg.change_feed (batchId)",
+    ],
+}
+SUMMARY_TABLES = [
+    "LTCC_PRO.dspg.lot_summary",
+    "LTCC_PRO.dspg.substrate_summary",
+    "LTCC_PRO.dspg.defect_histogram",
+]
+BACKFILL_TABLES = [
+    "LTCC_PRO.dspg.lot_data",
+    "LTCC_PRO.dspg.circuit_data",
+]
+
 
 # Classes
-class bcolors:
-    HEADER = "\033[95m"
-    OKBLUE = "\033[94m"
-    OKGREEN = "\033[92m"
-    WARNING = "\033[93m"
-    FAIL = "\033[91m"
-    BOLD = "\033[1m"
-    UNDERLINE = "\033[4m"
-    ENDC = "\033[0m"
-
-    # Method that returns a message with the desired color
-    # usage:
-    #    print(bcolor.colored("My colored message", bcolor.OKBLUE))
-    @staticmethod
-    def colored(message, color):
-        return color + message + bcolors.ENDC
-
-    # Method that returns a yellow warning
-    # usage:
-    #   print(bcolors.warning("What you are about to do is potentially dangerous. Continue?"))
-    @staticmethod
-    def warning(message):
-        return bcolors.WARNING + message + bcolors.ENDC
-
-    # Method that returns a red fail
-    # usage:
-    #   print(bcolors.fail("What you did just failed massively. Bummer"))
-    #   or:
-    #   sys.exit(bcolors.fail("Not a valid date"))
-    @staticmethod
-    def fail(message):
-        return bcolors.FAIL + message + bcolors.ENDC
-
-    # Method that returns a green ok
-    # usage:
-    #   print(bcolors.ok("What you did just ok-ed massively. Yay!"))
-    @staticmethod
-    def ok(message):
-        return bcolors.OKGREEN + message + bcolors.ENDC
-
-    # Method that returns a blue ok
-    # usage:
-    #   print(bcolors.okblue("What you did just ok-ed into the blue. Wow!"))
-    @staticmethod
-    def okblue(message):
-        return bcolors.OKBLUE + message + bcolors.ENDC
-
-    # Method that returns a header in some purple-ish color
-    # usage:
-    #   print(bcolors.header("This is great"))
-    @staticmethod
-    def header(message):
-        return bcolors.HEADER + message + bcolors.ENDC
-
-
-# class to hold lot data
-class LotData:
+# compact index of circuit_data primary keys (lot, substrate, circuit, layer)
+# each key is packed into one uint64 and kept in a sorted NumPy array, about 8 bytes
+# per key instead of a few hundred for a tuple in a set
+# keys that don't fit the packed layout go to a small overflow set
+class CircuitKeyIndex:
     def __init__(self):
-        self.lotNum: int = 0
-        self.machine: str = "NULL"
-        self.layout: str = "NA"
-        self.layer: str = "NA"
-        self.startDate: datetime = None
-        self.endDate: datetime = None
+        self.keys = np.empty(0, dtype=np.uint64)  # sorted, unique
+        self.added: Set[int] = set()  # packed keys added during this run
+        self.overflow: Set[Tuple[str, int, int, str]] = set()
+        self.bloom: np.ndarray = None  # optional bit array in front of self.keys
+        self.bloom_shift = 0
+
+    def __len__(self) -> int:
+        return len(self.keys) + len(self.added) + len(self.overflow)
+
+    def __contains__(self, key: Tuple) -> bool:
+        packed = pack_circuit_key(*key)
+        if packed is None:
+            return normalize_circuit_key(*key) in self.overflow
+        if packed in self.added:
+            return True
+        if self.bloom is not None and not self._bloom_contains(packed):
+            return False
+        i = np.searchsorted(self.keys, np.uint64(packed))
+        return bool(i < len(self.keys) and self.keys[i] == packed)
+
+    # membership of many circuits of one lot-layer at once, one searchsorted for all
+    # of them, the Bloom filter only speeds up single lookups
+    def contains_many(
+        self, lotNum, layer: str, substrates: List[int], circuits: List[int]
+    ) -> np.ndarray:
+        n = len(substrates)
+        found = np.zeros(n, dtype=bool)
+        if n == 0:
+            return found
+
+        packed, fits, overflow = pack_circuit_keys(
+            [lotNum] * n, substrates, circuits, [layer] * n
+        )
+        hits = np.zeros(len(packed), dtype=bool)
+        if len(self.keys) > 0:
+            i = np.searchsorted(self.keys, packed)
+            hits = self.keys[np.minimum(i, len(self.keys) - 1)] == packed
+        if self.added:
+            added = np.fromiter(self.added, dtype=np.uint64, count=len(self.added))
+            hits |= np.isin(packed, added)
+        found[fits] = hits
+        if overflow:
+            found[~fits] = [key in self.overflow for key in overflow]
+        return found
+
+    def add(self, key: Tuple):
+        packed = pack_circuit_key(*key)
+        if packed is None:
+            self.overflow.add(normalize_circuit_key(*key))
+        else:
+            self.added.add(packed)
+
+    # load the keys in circuit_data, a chunk of rows at a time
+    # lot_layers limits it to those (lotNum, layer) pairs instead of the whole table
+    @classmethod
+    def from_db(
+        cls, cursor: pyodbc.Cursor, lot_layers: Optional[Set[Tuple]] = None
+    ) -> "CircuitKeyIndex":
+        index = cls()
+        chunks = list()
+
+        if lot_layers is None:
+            cursor.execute(
+                "SELECT lotNum, substrateNum, circuitNum, layer FROM LTCC_PRO.dspg.circuit_data"
+            )
+        else:
+            # temp table typed like lot_data so the join needs no conversions
+            cursor.execute(
+                "SELECT TOP 0 lotNum, layer INTO #key_lot_layers FROM LTCC_PRO.dspg.lot_data"
+            )
+            if lot_layers:
+                cursor.executemany(
+                    "INSERT INTO #key_lot_layers (lotNum, layer) VALUES (?, ?)",
+                    list(lot_layers),
+                )
+            cursor.execute(
+                """
+                SELECT c.lotNum, c.substrateNum, c.circuitNum, c.layer
+                FROM LTCC_PRO.dspg.circuit_data c
+                INNER JOIN #key_lot_layers k ON k.lotNum = c.lotNum AND k.layer = c.layer
+                """
+            )
+        while True:
+            rows = cursor.fetchmany(KEY_FETCH_ROWS)
+            if not rows:
+                break
+            packed, _, overflow = pack_circuit_keys(
+                [row[0] for row in rows],
+                [row[1] for row in rows],
+                [row[2] for row in rows],
+                [row[3] for row in rows],
+            )
+            chunks.append(packed)
+            index.overflow.update(overflow)
 
-        self.substrateCnt: int = 0
+        if lot_layers is not None:
+            cursor.execute("DROP TABLE #key_lot_layers")
 
-        self.inputES: int = 0
-        self.reviewedES: int = 0
-        self.goodES: int = 0
-        self.rejectES: int = 0
-        self.outputES: int = 0
+        if chunks:
+            index.keys = np.unique(np.concatenate(chunks))
+        if KEY_INDEX_BLOOM:
+            index._build_bloom()
 
-        self.circuitData: List[CircuitData] = list()
+        log(
+            f"Loaded {len(index.keys)} circuit keys ({index.keys.nbytes} bytes), {len(index.overflow)} unpacked"
+        )
+        return index
+
+    def _build_bloom(self):
+        nbits = max(64, int(len(self.keys) * BLOOM_BITS_PER_KEY))
+        log2_bits = int(np.ceil(np.log2(nbits)))
+        self.bloom = np.zeros(2 ** log2_bits // 8, dtype=np.uint8)
+        self.bloom_shift = 64 - log2_bits
+        for mult in BLOOM_MULTIPLIERS:
+            pos = (self.keys * np.uint64(mult)) >> np.uint64(self.bloom_shift)
+            np.bitwise_or.at(
+                self.bloom,
+                (pos >> np.uint64(3)).astype(np.int64),
+                (np.uint8(1) << (pos & np.uint64(7)).astype(np.uint8)),
+            )
 
-    def __repr__(self) -> str:
-        reprStr = ""
-        reprStr += f"lotNum: {self.lotNum}\n"
-        reprStr += f"machine: {self.machine}\n"
-        reprStr += f"layout: {self.layout}\n"
-        reprStr += f"layer: {self.layer}\n"
-        reprStr += f"num substrates: {self.substrateCnt}\n"
-        reprStr += f"num failures: {len(self.circuitData)}\n"
+    def _bloom_contains(self, packed: int) -> bool:
+        for mult in BLOOM_MULTIPLIERS:
+            pos = ((packed * mult) & 0xFFFFFFFFFFFFFFFF) >> self.bloom_shift
+            if not self.bloom[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
 
-        return reprStr
 
+# Functions
+# circuit keys as stored in the overflow set of CircuitKeyIndex
+def normalize_circuit_key(
+    lotNum, substrateNum, circuitNum, layer
+) -> Tuple[str, int, int, str]:
+    return (str(lotNum).replace("-", ""), int(substrateNum), int(circuitNum), str(layer))
 
-# class to hold circuit data
-class CircuitData:
-    def __init__(self):
-        self.lotNum: int = 0
-        self.substrateNum: int = 0
-        self.circuitNum: int = 0
-        self.status: str = "No Failure"
-        self.didStop: bool = False
-        self.length: int = 0
-        self.breadth: int = 0
-        self.area: int = 0
-
-    def __repr__(self) -> str:
-        reprStr = ""
-        reprStr += f"lotNum: {self.lotNum}\n"
-        reprStr += f"substrateNum: {self.substrateNum}\n"
-        reprStr += f"circuitNum: {self.circuitNum}\n"
-        reprStr += f"status: {self.status}\n"
-        reprStr += f"dimensions: {self.length} x {self.breadth}\n"
-        reprStr += f"area: {self.area}\n"
-
-        return reprStr
 
+# layer code for packed keys: 'A2' -> 12, 'Z9' -> 269, None if it isn't letter + digit
+def get_layer_code(layer: str) -> Optional[int]:
+    if len(layer) != 2 or not ("A" <= layer[0] <= "Z") or not layer[1].isdigit():
+        return None
+    return (ord(layer[0]) - ord("A") + 1) * 10 + int(layer[1])
 
-# Functions
-def log(msg: str):  # simple logger
-    if DEV:
-        print(f"{datetime.now()}: {msg}")
-        with open(OUT_FILE, "a") as of:
-            print(f"{datetime.now()}: {msg}", file=of)
-    else:
-        print(f"{datetime.now()}: {msg}")
-
-
-def init_db() -> pyodbc.Connection:  # connect to db
-    # connection parameters
-    server = r"secret"
-    database = "LTCC_PRO"
-    username = "dspuser"
-    password = "dspus3r"
-    driver = "{ODBC Driver 17 for SQL Server}"
-
-    # connect to database
-    cnxn = pyodbc.connect(
-        "DRIVER="
-        + driver
-        + ";SERVER="
-        + server
-        + ";DATABASE="
-        + database
-        + ";UID="
-        + username
-        + ";PWD="
-        + password
+
+# pack a circuit key into a uint64: lot | substrate | circuit + 1 | layer
+# returns None if a field doesn't fit the layout
+def pack_circuit_key(lotNum, substrateNum, circuitNum, layer) -> Optional[int]:
+    try:
+        lot, substrate, circuit, layer = normalize_circuit_key(
+            lotNum, substrateNum, circuitNum, layer
+        )
+        lot = int(lot)
+    except ValueError:
+        return None
+    layer_code = get_layer_code(layer)
+    circuit += 1  # corrupted lines use circuit -1
+
+    if (
+        layer_code is None
+        or not 0 <= lot < 1 << KEY_LOT_BITS
+        or not 0 <= substrate < 1 << KEY_SUBSTRATE_BITS
+        or not 0 <= circuit < 1 << KEY_CIRCUIT_BITS
+    ):
+        return None
+
+    return (
+        (lot << KEY_SUBSTRATE_BITS | substrate) << KEY_CIRCUIT_BITS | circuit
+    ) << KEY_LAYER_BITS | layer_code
+
+
+# vectorized pack_circuit_key
+# returns the packed keys of the rows that fit, which rows those are, and the
+# normalized keys of the rows that don't
+def pack_circuit_keys(
+    lotNums: List, substrateNums: List, circuitNums: List, layers: List[str]
+) -> Tuple[np.ndarray, np.ndarray, List[Tuple[str, int, int, str]]]:
+    # sister lots: 123456-2 -> 1234562
+    lot_strs = np.char.replace(np.array([str(lot) for lot in lotNums]), "-", "")
+    lots = np.full(len(lot_strs), -1, dtype=np.int64)
+    numeric = np.char.isdigit(lot_strs) & (np.char.str_len(lot_strs) <= 18)
+    lots[numeric] = lot_strs[numeric].astype(np.int64)
+
+    substrates = np.array(substrateNums, dtype=np.int64)
+    circuits = np.array(circuitNums, dtype=np.int64) + 1
+
+    # few distinct layers, look each one up once
+    unique_layers, layer_idx = np.unique(np.array(layers, dtype=str), return_inverse=True)
+    layer_codes = np.array(
+        [get_layer_code(layer) or -1 for layer in unique_layers], dtype=np.int64
+    )[layer_idx]
+
+    fits = (
+        (lots >= 0)
+        & (lots < 1 << KEY_LOT_BITS)
+        & (substrates >= 0)
+        & (substrates < 1 << KEY_SUBSTRATE_BITS)
+        & (circuits >= 0)
+        & (circuits < 1 << KEY_CIRCUIT_BITS)
+        & (layer_codes >= 0)
     )
-    return cnxn
 
+    packed = (
+        (lots[fits].astype(np.uint64) << np.uint64(KEY_SUBSTRATE_BITS))
+        | substrates[fits].astype(np.uint64)
+    ) << np.uint64(KEY_CIRCUIT_BITS)
+    packed = (packed | circuits[fits].astype(np.uint64)) << np.uint64(KEY_LAYER_BITS)
+    packed |= layer_codes[fits].astype(np.uint64)
 
-# sort list[lotData] by start date
-def sort_by_startDate(lot_data_list: List[LotData]) -> List[LotData]:
-    return sorted(lot_data_list, key=lambda lot: lot.startDate)
+    overflow = [
+        (str(lot_strs[i]), int(substrateNums[i]), int(circuitNums[i]), str(layers[i]))
+        for i in np.flatnonzero(~fits)
+    ]
+    return packed, fits, overflow
 
 
-# extract time from string
-def extract_time(time_str: str) -> List[int]:
-    # Split the time string into hours, minutes, and AM/PM
-    parts = time_str.split(":")
-    hour_str, minute_str = parts[0], parts[1][:2]
-    am_pm = parts[1][2:].strip().upper()
+# rank of a layer in PRIORITY_LAYERS, unlisted layers come last
+def get_layer_rank(layer: str) -> int:
+    if layer in PRIORITY_LAYERS:
+        return PRIORITY_LAYERS.index(layer)
+    return len(PRIORITY_LAYERS)
 
-    # Convert hour to 24-hour format
-    hour = int(hour_str)
-    if am_pm == "PM" and hour != 12:
-        hour += 12
-    elif am_pm == "AM" and hour == 12:
-        hour = 0
 
-    # Extract minute and second
-    minute = int(minute_str)
-    second = 0
+# order candidate files by layer priority, then by age according to SCHEDULE_ORDER
+def schedule_files(entries: List[os.DirEntry]) -> List[os.DirEntry]:
+    def priority(entry: os.DirEntry) -> Tuple[int, float]:
+        layer_match = layer_prog.search(entry.name)
+        layer = layer_match[0][1:3] if layer_match else "NA"
+        mtime = entry.stat().st_mtime
+        return (get_layer_rank(layer), -mtime if SCHEDULE_ORDER == "newest" else mtime)
 
-    return hour, minute, second
+    return sorted(entries, key=priority)
 
 
-# main parsing function
-# loops thru file line by line and extracts data
-def parse_data_from_file(path: str) -> LotData:
-    # Ensure path exists
-    if not os.path.isfile(path):
-        return Exception(f"{path} is not a file!")
-    else:
-        log(f"Parsing data from {path}...")
-        with open(path, "r") as f:
-            content = f.read()
-
-    # Initialize
-    data = LotData()
-    substrateNum = 0
-    bak_substrateCnt = 0
-
-    # extract layer from filename
-    layer_match = layer_prog.search(os.path.basename(path))
-    if layer_match:
-        data.layer = layer_match[0][1:3]  # get 'A2' from '_A2_'
-    else:
-        data.layer = "NA"
+# sort key for a parsed lot, by layer priority then start date
+# lots without a start date go after the dated ones of their layer
+def get_lot_priority(lot: LotData) -> Tuple[int, bool, float]:
+    if lot.startDate is None:
+        return (get_layer_rank(lot.layer), True, 0.0)
+    start = lot.startDate.timestamp()
+    return (get_layer_rank(lot.layer), False, -start if SCHEDULE_ORDER == "newest" else start)
 
-    for line in content.splitlines():
-        match = prog.search(line)
-        if match:
-            param = match[1].strip()
-            value = match[2].strip()
 
-            if param == "Machine":
-                if value == "BoschDsp - AOI":
-                    data.machine = "NULL"
-                else:
-                    data.machine = value
-            elif param == "Typ":
-                data.layout = value
-            elif param == "ChargenNr":
-                data.lotNum = value
-                # Check for sister lots
-                if "-" in data.lotNum:
-                    oldLotNum = data.lotNum
-                    num, sister = data.lotNum.split("-")
-                    data.lotNum = int(str(num) + str(sister))
-                    log(
-                        bcolors.warning(
-                            f"Amending sister lot {oldLotNum} -> {data.lotNum}"
-                        )
-                    )
-            elif param == "StartDate":
-                data.startDate = datetime.strptime(value, DATE_FORMAT)
-            elif param == "StartTime":
-                hour, minute, second = extract_time(value)
-                data.startDate = data.startDate.replace(
-                    hour=hour, minute=minute, second=second
-                )
-            elif param == "EndDate":
-                data.endDate = datetime.strptime(value, DATE_FORMAT)
-            elif param == "EndTime":
-                hour, minute, second = extract_time(value)
-                data.endDate = data.endDate.replace(
-                    hour=hour, minute=minute, second=second
-                )
-            elif param == "GS-Input":
-                data.substrateCnt = int(value)
-            elif param == "ES-Input":
-                data.inputES = value
-            elif param == "ES-Reviewed":
-                data.reviewedES = value
-            elif param == "ES-Good":
-                data.goodES = value.split()[0]
-            elif param == "Total-rejects":
-                data.rejectES = value
-            elif param == "ES-Output":
-                data.outputES = value
-            elif param == "GS":
-                substrateNum = value.split("A")[0]
-                bak_substrateCnt += 1
-        elif line.startswith("\tES "):  # extract circuit data
-            circuit_data = CircuitData()
-
-            circuit_data.lotNum = data.lotNum
-            circuit_data.substrateNum = substrateNum  # starts at 1!
-
-            circuit_match = circuit_prog.search(line)
-            if circuit_match:
-                circuit_data.circuitNum = circuit_match[1]
-
-                if circuit_match[2] == "1001":
-                    circuit_data.status = "NonRepairable"
-                elif circuit_match[2] == "1002":
-                    circuit_data.status = "Repairable"
-                elif circuit_match[2] == "1003":
-                    circuit_data.status = "FalseDefect"
-                else:
-                    circuit_data.status = "NotReviewed"
-
-                circuit_data.length = circuit_match[3]
-                circuit_data.breadth = circuit_match[4]
-                circuit_data.area = circuit_match[5]
-            else:  # corrupted data on this line
-                circuit_data.circuitNum = -1
-                circuit_data.status = "Unknown"
-                circuit_data.length = -1
-                circuit_data.breadth = -1
-                circuit_data.area = -1
-
-            # Check if circuit caused stop
-            if "Serial" in line and "True" in line:
-                circuit_data.didStop = True
-
-            data.circuitData.append(circuit_data)
-
-            log("Circuit data extracted:" + "\n" + repr(circuit_data))
-        elif line.startswith("\tNo Failure"):
-            # continue  # don't do anything to lines that don't have a failure - reduce lines in DB
-            circuit_data = CircuitData()
-            circuit_data.lotNum = data.lotNum
-            circuit_data.substrateNum = substrateNum
-            circuit_data.circuitNum = 0
-            circuit_data.status = "No Failure"
-
-            log("Circuit data extracted:" + "\n" + repr(circuit_data))
-            # data.circuitData.append(circuit_data)
+# order parsed lots the same way as their files
+def schedule_lots(lot_data_list: List[LotData]) -> List[LotData]:
+    return sorted(lot_data_list, key=get_lot_priority)
+
+
+# has the run used up its time budget? share limits the check to part of the budget
+def over_time_budget(run_start: datetime, share: float = 1.0) -> bool:
+    if RUN_TIME_BUDGET_SECONDS is None:
+        return False
+    elapsed = (datetime.now() - run_start).total_seconds()
+    return elapsed > RUN_TIME_BUDGET_SECONDS * share
+
+
+# create any missing tables listed in TABLE_DDL
+# new summary tables are seeded once from the circuit_data history
+def ensure_tables(cursor: pyodbc.Cursor):
+    created = list()
+    for table, statements in TABLE_DDL.items():
+        if cursor.execute("SELECT OBJECT_ID(?, 'U')", table).fetchone()[0] is None:
+            for strSQL in statements:
+                cursor.execute(strSQL)
+            created.append(table)
+
+    if any(table in SUMMARY_TABLES for table in created):
+        log("Summarizing existing circuit_data...")
+        rebuild_summaries(
+            cursor, "SELECT DISTINCT lotNum, layer FROM LTCC_PRO.dspg.circuit_data"
+        )
+
+
+# rebuild the summary rows of some lot-layers from what circuit_data holds now
+# lot_layers is a query returning lotNum and layer columns, params are its parameters
+def rebuild_summaries(cursor: pyodbc.Cursor, lot_layers: str, params: Tuple = ()):
+    for table in SUMMARY_TABLES:
+        cursor.execute(
+            f"DELETE t FROM {table} t INNER JOIN ({lot_layers}) ll ON ll.lotNum = t.lotNum AND ll.layer = t.layer",
+            params,
+        )
+
+    cursor.execute(
+        f"""
+        INSERT INTO LTCC_PRO.dspg.lot_summary (lotNum, layer, status, circuitCnt, stopCnt)
+        SELECT c.lotNum, c.layer, c.status, COUNT(*), SUM(CASE WHEN c.didStop = 1 THEN 1 ELSE 0 END)
+        FROM LTCC_PRO.dspg.circuit_data c
+        INNER JOIN ({lot_layers}) ll ON ll.lotNum = c.lotNum AND ll.layer = c.layer
+        GROUP BY c.lotNum, c.layer, c.status
+        """,
+        params,
+    )
+    cursor.execute(
+        f"""
+        INSERT INTO LTCC_PRO.dspg.substrate_summary (lotNum, layer, substrateNum, defectCnt, stopCnt)
+        SELECT c.lotNum, c.layer, c.substrateNum, COUNT(*), SUM(CASE WHEN c.didStop = 1 THEN 1 ELSE 0 END)
+        FROM LTCC_PRO.dspg.circuit_data c
+        INNER JOIN ({lot_layers}) ll ON ll.lotNum = c.lotNum AND ll.layer = c.layer
+        GROUP BY c.lotNum, c.layer, c.substrateNum
+        """,
+        params,
+    )
+
+    # one row per bin, empty bins included, corrupted lines have no dimensions
+    bins = list()
+    for metric, edges in (("length", LENGTH_BINS), ("area", AREA_BINS)):
+        for i, edge in enumerate(edges):
+            binEnd = float(edges[i + 1]) if i + 1 < len(edges) else "NULL"
+            bins.append(f"('{metric}', {float(edge)}, CAST({binEnd} AS FLOAT))")
+    value = "CASE b.metric WHEN 'length' THEN c.length ELSE c.area END"
+    cursor.execute(
+        f"""
+        INSERT INTO LTCC_PRO.dspg.defect_histogram (lotNum, layer, metric, binStart, binEnd, circuitCnt)
+        SELECT ll.lotNum, ll.layer, b.metric, b.binStart, b.binEnd, COUNT(c.circuitNum)
+        FROM ({lot_layers}) ll
+        CROSS JOIN (VALUES {", ".join(bins)}) b (metric, binStart, binEnd)
+        LEFT JOIN LTCC_PRO.dspg.circuit_data c
+            ON c.lotNum = ll.lotNum AND c.layer = ll.layer AND c.status <> 'Unknown'
+            AND {value} >= b.binStart AND (b.binEnd IS NULL OR {value} < b.binEnd)
+        GROUP BY ll.lotNum, ll.layer, b.metric, b.binStart, b.binEnd
+        """,
+        params,
+    )
+
+
+# recursively list all files under a directory
+# DirEntry.stat() is served from the directory listing on Windows, so sizes are free
+def get_all_file_entries(dirname: str) -> Generator[os.DirEntry, None, None]:
+    with os.scandir(dirname) as dir_entries:
+        for entry in dir_entries:
+            if entry.is_dir():
+                yield from get_all_file_entries(entry.path)
+            elif entry.is_file():
+                yield entry
+
+
+# get all log files under DATA_PATH
+# logs with a parsed record next to them are swapped for the record
+def get_log_files() -> List[os.DirEntry]:
+    entries = list()
+    records = dict()
+    for entry in get_all_file_entries(DATA_PATH):
+        if entry.name.endswith(RECORD_EXT):
+            records[entry.path] = entry
+        elif not entry.name.endswith(RECORD_EXT + ".tmp"):
+            entries.append(entry)
+
+    return [records.get(entry.path + RECORD_EXT, entry) for entry in entries]
+
+
+# get log files that still need parsing
+def get_files_to_parse(current_lots: List[str]) -> List[os.DirEntry]:
+    files = list()
+    for entry in get_log_files():
+        file = entry.name
+        # Check if lot-layer pair has been parsed already, if so, skip
+        if any(
+            str(lotNum)[:6] in file and layer in file
+            for lotNum, machine, layer in existing_lot_data_keys
+        ) or any(str(lotNum) in file for lotNum in current_lots):
             continue
+        files.append(entry)
+    return files
+
 
-    log("Lot data extracted:" + "\n" + repr(data))
+# read files ahead of the consumer on a thread pool so share latency overlaps parsing
+# yields (path, content) in the order given, content is the Exception if the read failed
+def prefetch_files(
+    entries: List[os.DirEntry],
+) -> Generator[Tuple[str, Union[str, Exception]], None, None]:
+    executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+    pending = deque()  # (path, size, future)
+    in_flight = 0
+    entries = iter(entries)
+    next_entry = next(entries, None)
+
+    try:
+        while next_entry is not None or pending:
+            # queue reads while under budget, always keep at least one going
+            while next_entry is not None and len(pending) < PREFETCH_MAX_FILES:
+                try:
+                    size = next_entry.stat().st_size
+                except OSError:
+                    size = 0
+                if pending and in_flight + size > PREFETCH_MAX_BYTES:
+                    break
+                future = executor.submit(read_file, next_entry.path)
+                pending.append((next_entry.path, size, future))
+                in_flight += size
+                next_entry = next(entries, None)
+
+            path, size, future = pending.popleft()
+            in_flight -= size
+            try:
+                content = future.result()
+            except Exception as e:
+                content = e
+            yield path, content
+    finally:
+        # consumer stopped early or finished, drop any reads not yet started
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# parse a log file, skipping lots that were already parsed
+# content can be passed in if the file was already read (see prefetch_files)
+def parse_data_from_file(path: str, content: str = None) -> LotData:
+    data = parse_log_file(path, content)
+    if isinstance(data, Exception):
+        return data
+
+    return (
+        data
+        if get_lot_key(data.lotNum, data.machine, data.layer)
+        not in existing_lot_data_keys
+        else Exception(f"Lot {data.lotNum} has already been parsed!")
+    )
+
+
+# load a parsed record written by file-sync.py
+def parse_data_from_record(path: str, content: bytes) -> LotData:
+    log(f"Loading parsed record {path}...")
+    data, _ = unpack_lot_data(content)
 
     return (
         data
-        if (data.lotNum, data.machine, data.layer) not in existing_lot_data_keys
+        if get_lot_key(data.lotNum, data.machine, data.layer)
+        not in existing_lot_data_keys
         else Exception(f"Lot {data.lotNum} has already been parsed!")
     )
 
@@ -352,54 +620,649 @@ def get_running_lots() -> List[str]:
     return running_lots
 
 
-# get list of lots that we have already parsed
-def get_parsed_lots() -> List[Tuple[str, str]]:
-    parsed_lots = list()
+# Change feed
+# every upload transaction gets a batch in ingest_batch and one change_feed row per
+# lot_data/circuit_data row it inserted, upgraded to NonRepairable or deleted
+# batchId is the watermark, but batchIds are handed out before the data commits and
+# can commit out of order: the batch row is committed on its own with finishedAt
+# NULL, and finishedAt is set in the data transaction, so consumers only read
+# batches below the lowest unfinished one
+
+# start a change batch and return its id, committed on its own connection so
+# consumers see it as unfinished until the data transaction sets finishedAt
+def begin_batch(source: str) -> int:
+    def insert(cnxn: pyodbc.Connection) -> int:
+        cursor = cnxn.cursor()
+        cursor.execute(
+            "INSERT INTO LTCC_PRO.dspg.ingest_batch (source, startedAt) OUTPUT INSERTED.batchId VALUES (?, ?)",
+            (source, datetime.now()),
+        )
+        batchId = cursor.fetchone()[0]
+        cnxn.commit()
+        return batchId
 
-    # get all lotnums from SQL
-    strSQL = "SELECT lotNum, layer from LTCC_PRO.dspg.lot_data"
-    cursor.execute(strSQL)
+    return db_pool.run(insert)
 
-    rows = cursor.fetchall()
-    for row in rows:
-        parsed_lots.append((row[0], row[1]))
 
-    return parsed_lots
+# close a batch whose data transaction rolled back, so it stops holding back
+# consumers, a batch missed here is closed later by close_stale_batches
+def abandon_batch(batchId: int):
+    def update(cnxn: pyodbc.Connection):
+        cnxn.cursor().execute(
+            "UPDATE LTCC_PRO.dspg.ingest_batch SET finishedAt = ?, changeCnt = 0 WHERE batchId = ? AND finishedAt IS NULL",
+            (datetime.now(), batchId),
+        )
+        cnxn.commit()
 
+    try:
+        db_pool.run(update)
+    except Exception as e:
+        log(bcolors.warning(f"Could not close batch {batchId}: {repr(e)}"))
 
-# Main
-def main():
-    print(bcolors.header("Program started."))
-    print("Please wait...")
 
-    # Setup
-    log("Initializing...")
-    cnxn = init_db()
-    global cursor
+# close batches left unfinished by runs that died, committed by the caller
+def close_stale_batches(cursor: pyodbc.Cursor):
+    cursor.execute(
+        "UPDATE LTCC_PRO.dspg.ingest_batch SET finishedAt = ?, changeCnt = 0 WHERE finishedAt IS NULL AND startedAt < ?",
+        (datetime.now(), datetime.now() - timedelta(seconds=BATCH_STALE_SECONDS)),
+    )
+    if cursor.rowcount > 0:
+        log(bcolors.warning(f"Closed {cursor.rowcount} stale change batches."))
+
+
+# write the batch's change records, changes are
+# (tableName, changeType, lotNum, machine, layer, substrateNum, circuitNum)
+def finish_batch(cursor: pyodbc.Cursor, batchId: int, changes: List[Tuple]):
+    if changes:
+        cursor.executemany(
+            "INSERT INTO LTCC_PRO.dspg.change_feed (batchId, tableName, changeType, lotNum, machine, layer, substrateNum, circuitNum) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(batchId, *change) for change in changes],
+        )
+    cursor.execute(
+        "UPDATE LTCC_PRO.dspg.ingest_batch SET finishedAt = ?, changeCnt = ? WHERE batchId = ?",
+        (datetime.now(), len(changes), batchId),
+    )
+    log(f"Batch {batchId}: {len(changes)} changes recorded.")
+
+
+# lot_data and circuit_data rows as executemany parameters, columns in the order of
+# LOT_COLUMNS and CIRCUIT_COLUMNS
+LOT_COLUMNS = "lotNum, machine, layout, startDate, endDate, inputES, reviewedES, goodES, rejectES, outputES, layer, substrateCnt"
+CIRCUIT_COLUMNS = "lotNum, substrateNum, circuitNum, status, length, breadth, area, didStop, layer"
+
+
+def get_lot_row(lot: LotData) -> Tuple:
+    return (
+        lot.lotNum,
+        lot.machine,
+        lot.layout,
+        lot.startDate,
+        lot.endDate,
+        lot.inputES,
+        lot.reviewedES,
+        lot.goodES,
+        lot.rejectES,
+        lot.outputES,
+        lot.layer,
+        lot.substrateCnt,
+    )
+
+
+def get_circuit_row(lot: LotData, circuit: CircuitData) -> Tuple:
+    return (
+        lot.lotNum,
+        circuit.substrateNum,
+        circuit.circuitNum,
+        circuit.status,
+        circuit.length,
+        circuit.breadth,
+        circuit.area,
+        1 if circuit.didStop is True else 0,
+        lot.layer,
+    )
+
+
+# Backfill
+# stage a parsed lot, replacing anything staged earlier for the same lot
+# selected lots matched the backfill filters, the others are staged so that every
+# machine's rows for a selected lot-layer are there when it is merged
+def stage_lot(cursor: pyodbc.Cursor, lot: LotData, selected: bool):
+    lot_key = (lot.lotNum, lot.machine, lot.layer)
+    for table in BACKFILL_TABLES:
+        cursor.execute(
+            f"DELETE FROM {table}{STAGE_SUFFIX} WHERE lotNum = ? AND machine = ? AND layer = ?",
+            lot_key,
+        )
+
+    cursor.execute(
+        f"INSERT INTO LTCC_PRO.dspg.lot_data{STAGE_SUFFIX} ({LOT_COLUMNS}, selected) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (*get_lot_row(lot), 1 if selected else 0),
+    )
+
+    rows = [(*get_circuit_row(lot, circuit), lot.machine) for circuit in lot.circuitData]
+    if rows:
+        cursor.executemany(
+            f"INSERT INTO LTCC_PRO.dspg.circuit_data{STAGE_SUFFIX} ({CIRCUIT_COLUMNS}, machine) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+
+# create the staging copies of the backfill tables
+def ensure_stage_tables(cursor: pyodbc.Cursor):
+    for table in BACKFILL_TABLES:
+        stage = table + STAGE_SUFFIX
+        strSQL = f"IF OBJECT_ID('{stage}', 'U') IS NULL SELECT TOP 0 * INTO {stage} FROM {table}"
+        cursor.execute(strSQL)
+
+    # circuit_data has no machine column, staging needs it to replace a single lot
+    stage = "LTCC_PRO.dspg.circuit_data" + STAGE_SUFFIX
+    cursor.execute(
+        f"IF COL_LENGTH('{stage}', 'machine') IS NULL ALTER TABLE {stage} ADD machine VARCHAR(50) NULL"
+    )
+
+    # lots staged only to complete a selected lot-layer have selected = 0
+    stage = "LTCC_PRO.dspg.lot_data" + STAGE_SUFFIX
+    cursor.execute(
+        f"IF COL_LENGTH('{stage}', 'selected') IS NULL ALTER TABLE {stage} ADD selected BIT NULL"
+    )
+
+
+# empty the staging tables
+def clear_stage_tables(cursor: pyodbc.Cursor):
+    for table in BACKFILL_TABLES:
+        cursor.execute(f"DELETE FROM {table}{STAGE_SUFFIX}")
+
+
+# drop staged lot-layers that can't be merged safely: ones no selected lot belongs
+# to, and ones where a machine with rows in lot_data wasn't staged (skipped, failed
+# to parse or outside the pre-filters), merging those would lose that machine's
+# circuits
+def prune_stage_tables(cursor: pyodbc.Cursor):
+    stage = "LTCC_PRO.dspg.lot_data" + STAGE_SUFFIX
+
+    cursor.execute(
+        f"""
+        SELECT DISTINCT l.lotNum, l.layer, l.machine
+        FROM LTCC_PRO.dspg.lot_data l
+        WHERE EXISTS (SELECT 1 FROM {stage} s WHERE s.lotNum = l.lotNum AND s.layer = l.layer AND s.selected = 1)
+        AND NOT EXISTS (SELECT 1 FROM {stage} s WHERE s.lotNum = l.lotNum AND s.layer = l.layer AND s.machine = l.machine)
+        """
+    )
+    for row in cursor.fetchall():
+        log(
+            bcolors.warning(
+                f"Skipping lot {row.lotNum}, layer {row.layer}: machine {row.machine} was not staged."
+            )
+        )
+
+    unmergeable = f"""
+        NOT EXISTS (SELECT 1 FROM {stage} s WHERE s.lotNum = t.lotNum AND s.layer = t.layer AND s.selected = 1)
+        OR EXISTS (
+            SELECT 1 FROM LTCC_PRO.dspg.lot_data l
+            WHERE l.lotNum = t.lotNum AND l.layer = t.layer
+            AND NOT EXISTS (SELECT 1 FROM {stage} s WHERE s.lotNum = l.lotNum AND s.layer = l.layer AND s.machine = l.machine)
+        )
+    """
+    # circuits first, the check reads the staged lots
+    for table in reversed(BACKFILL_TABLES):
+        cursor.execute(f"DELETE t FROM {table}{STAGE_SUFFIX} t WHERE {unmergeable}")
+
+
+# swap staged lots into the live tables in one statement per table
+# every machine of a staged lot-layer is staged (see prune_stage_tables)
+# the replaced and new rows are written to change_feed under batchId
+def merge_stage_tables(cursor: pyodbc.Cursor, batchId: int):
+    stage = "LTCC_PRO.dspg.lot_data" + STAGE_SUFFIX
+    feed = "INSERT INTO LTCC_PRO.dspg.change_feed (batchId, tableName, changeType, lotNum, machine, layer, substrateNum, circuitNum)"
+
+    # circuit_data is keyed without machine, replace every circuit of a staged lot-layer
+    # and keep the NonRepairable row when both machines reported the same circuit
+    replaced = f"FROM LTCC_PRO.dspg.circuit_data c WHERE EXISTS (SELECT 1 FROM {stage} s WHERE s.lotNum = c.lotNum AND s.layer = c.layer)"
+    staged = f"""
+        FROM (
+            SELECT *, ROW_NUMBER() OVER (
+                PARTITION BY lotNum, substrateNum, circuitNum, layer
+                ORDER BY CASE WHEN status = 'NonRepairable' THEN 0 ELSE 1 END
+            ) AS rn
+            FROM LTCC_PRO.dspg.circuit_data{STAGE_SUFFIX}
+        ) staged
+        WHERE rn = 1
+    """
+    cursor.execute(
+        f"{feed} SELECT ?, 'circuit_data', 'deleted', c.lotNum, NULL, c.layer, c.substrateNum, c.circuitNum {replaced}",
+        batchId,
+    )
+    cursor.execute(f"DELETE c {replaced}")
+    cursor.execute(
+        f"""
+        INSERT INTO LTCC_PRO.dspg.circuit_data ({CIRCUIT_COLUMNS})
+        SELECT {CIRCUIT_COLUMNS}
+        {staged}
+        """
+    )
+    log(f"Merged {cursor.rowcount} circuits.")
+    cursor.execute(
+        f"{feed} SELECT ?, 'circuit_data', 'inserted', lotNum, NULL, layer, substrateNum, circuitNum {staged}",
+        batchId,
+    )
+
+    # lot_data rows in the feed, summaries are derived from them and aren't tracked
+    replaced = f"FROM LTCC_PRO.dspg.lot_data t WHERE EXISTS (SELECT 1 FROM {stage} s WHERE s.lotNum = t.lotNum AND s.layer = t.layer)"
+    cursor.execute(
+        f"{feed} SELECT ?, 'lot_data', 'deleted', t.lotNum, t.machine, t.layer, NULL, NULL {replaced}",
+        batchId,
+    )
+    cursor.execute(
+        f"{feed} SELECT ?, 'lot_data', 'inserted', lotNum, machine, layer, NULL, NULL FROM {stage}",
+        batchId,
+    )
+
+    # lot_data, every machine of the lot-layer is replaced
+    cursor.execute(f"DELETE t {replaced}")
+    cursor.execute(
+        f"INSERT INTO LTCC_PRO.dspg.lot_data ({LOT_COLUMNS}) SELECT {LOT_COLUMNS} FROM {stage}"
+    )
+    log(f"Merged {cursor.rowcount} lots.")
+
+    rebuild_summaries(cursor, f"SELECT DISTINCT lotNum, layer FROM {stage}")
+
+
+# parse one file in a backfill worker process
+# returns the packed lot so results are cheap to send back and whether it matched the
+# date and machine filters, None if it is for another layer
+def backfill_parse(
+    path: str, filters: Dict[str, str]
+) -> Optional[Tuple[bytes, bool]]:
+    if path.endswith(RECORD_EXT):
+        try:
+            lot, _ = unpack_lot_data(read_file(path))
+        except Exception:  # stale or damaged record, use the raw log
+            lot = parse_data_from_file(path[: -len(RECORD_EXT)])
+    else:
+        lot = parse_data_from_file(path)
+    if isinstance(lot, Exception):
+        raise lot
+
+    if filters["layer"] and lot.layer != filters["layer"]:
+        return None
+
+    selected = not (
+        lot.startDate is None
+        or (filters["start"] and lot.startDate < datetime.fromisoformat(filters["start"]))
+        or (filters["end"] and lot.startDate >= datetime.fromisoformat(filters["end"]))
+        or (filters["machine"] and lot.machine != filters["machine"])
+    )
+    return pack_lot_data(lot), selected
+
+
+# load backfill progress, starting over if the filters changed
+def load_backfill_state(filters: Dict[str, str]) -> Dict:
+    if os.path.isfile(BACKFILL_STATE_PATH):
+        with open(BACKFILL_STATE_PATH, "r") as f:
+            state = json.load(f)
+        if state["filters"] == filters:
+            return state
+        log(bcolors.warning("Backfill filters changed, discarding previous progress."))
+    return {"filters": filters, "done": list()}
+
+
+# write backfill progress atomically
+def save_backfill_state(state: Dict):
+    tmp_path = BACKFILL_STATE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, BACKFILL_STATE_PATH)
+
+
+# create the tables a backfill needs, emptying the stage tables for a fresh run
+def prepare_backfill(cnxn: pyodbc.Connection, clear: bool):
+    cursor = cnxn.cursor()
+    ensure_tables(cursor)
+    ensure_stage_tables(cursor)
+    if clear:
+        clear_stage_tables(cursor)
+    cnxn.commit()
+
+
+# stage a chunk of (path, backfill_parse result) in one transaction and return the
+# number of lots staged, safe to repeat since stage_lot replaces what it stages
+def stage_results(
+    cnxn: pyodbc.Connection, results: List[Tuple[str, Optional[Tuple[bytes, bool]]]]
+) -> int:
+    cursor = cnxn.cursor()
+    cursor.fast_executemany = True
+    staged_lots = 0
+    for _, result in results:
+        if result is not None:
+            packed, selected = result
+            lot, _ = unpack_lot_data(packed)
+            stage_lot(cursor, lot, selected)
+            staged_lots += 1
+    cnxn.commit()
+    return staged_lots
+
+
+# merge the staged lots and close the batch in one transaction, rolled back by the
+# pool if anything fails
+def merge_backfill(cnxn: pyodbc.Connection, batchId: int):
     cursor = cnxn.cursor()
+    prune_stage_tables(cursor)
+    merge_stage_tables(cursor, batchId)
+    cursor.execute(
+        "UPDATE LTCC_PRO.dspg.ingest_batch SET finishedAt = ?, changeCnt = (SELECT COUNT(*) FROM LTCC_PRO.dspg.change_feed WHERE batchId = ?) WHERE batchId = ?",
+        (datetime.now(), batchId, batchId),
+    )
+    clear_stage_tables(cursor)
+    cnxn.commit()
+
+
+# re-ingest every lot matching the filters, parsing in parallel into staging tables
+# and merging them into the live tables at the end
+# progress is kept in BACKFILL_STATE_PATH so an interrupted run picks up where it stopped
+# every database step runs through db_pool.run, so connections are always released
+# and transient errors are retried
+def backfill(
+    start: Optional[datetime],
+    end: Optional[datetime],
+    layer: Optional[str],
+    machine: Optional[str],
+    workers: int,
+):
+    print(bcolors.header("Backfill started."))
+
+    filters = {
+        "start": start.isoformat() if start else None,
+        "end": end.isoformat() if end else None,
+        "layer": layer,
+        "machine": machine,
+    }
+    state = load_backfill_state(filters)
+
+    db_pool.run(prepare_backfill, not state["done"])
+
+    # skip the lot being printed right now, same as main()
+    current_lots = list()
+    for lot in get_running_lots():
+        lot = lot.replace("-", "")
+        current_lots.append(lot)
+        current_lots.append(str(int(lot) + 1))
+
+    # cheap pre-filters on the file listing, the rest is checked after parsing
+    done = set(state["done"])
+    files = list()
+    for entry in get_log_files():
+        if entry.path in done:
+            continue
+        if any(lot in entry.name for lot in current_lots):
+            continue
+        if layer:
+            layer_match = layer_prog.search(entry.name)
+            if not layer_match or layer_match[0][1:3] != layer:
+                continue
+        if start and datetime.fromtimestamp(entry.stat().st_mtime) < start:
+            continue  # a log is finished after its lot starts
+        files.append(entry.path)
+
+    total = len(files) + len(done)
+    log(f"{len(files)} files to parse, {len(done)} already staged.")
+
+    staged_lots = 0
+    started = datetime.now()
+    results = list()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(backfill_parse, fp, filters): fp for fp in files}
+        for i, future in enumerate(as_completed(futures), 1):
+            fp = futures[future]
+            try:
+                results.append((fp, future.result()))
+            except Exception as e:
+                log(bcolors.warning(f"Error while parsing {fp}: {repr(e)}"))
+                results.append((fp, None))
+
+            if i % BACKFILL_COMMIT_FILES == 0 or i == len(files):
+                staged_lots += db_pool.run(stage_results, results)
+                state["done"].extend(fp for fp, _ in results)
+                results = list()
+                save_backfill_state(state)
+
+                elapsed = (datetime.now() - started).total_seconds()
+                rate = i / elapsed if elapsed else 0
+                eta = (len(files) - i) / rate if rate else 0
+                log(
+                    bcolors.okblue(
+                        f"Backfill {len(state['done'])}/{total} files, {staged_lots} lots staged, {rate:.1f} files/s, ETA {eta:.0f}s"
+                    )
+                )
 
-    lots_to_skip = list()
+    log("Merging staged lots into live tables...")
+    batchId = begin_batch("backfill")
+    try:
+        db_pool.run(merge_backfill, batchId)
+    except Exception as e:
+        abandon_batch(batchId)
+        log(bcolors.fail(f"Backfill merge failed, staged data kept: {repr(e)}"))
+        raise
 
-    log("Getting lots to skip...")
-    # get old lots from SQL
-    lot_layers: Dict[str, List[str]] = {}
-    for lot, layer in get_parsed_lots():
-        lot = str(lot)
+    if os.path.isfile(BACKFILL_STATE_PATH):
+        os.remove(BACKFILL_STATE_PATH)
+    log(bcolors.ok("Backfill complete."))
 
-        # Check for sister lots
-        if "-" in str(lot):
-            oldLotNum = lot
-            num, sister = lot.split("-")
-            lot = str(num) + str(sister)
-            log(bcolors.warning(f"Amending sister lot {oldLotNum} -> {lot}"))
 
-        lots_to_skip.append(lot)
+# Spool
+# parsed lots are appended to segment files in SPOOL_DIR and uploaded from there,
+# so a slow or unavailable database never throws parse work away
+# a segment is "<name>.open" while being written and "<name>.seg" once sealed,
+# each record is a length and CRC32 followed by a packed lot (see pack_lot_data)
+class SpoolWriter:
+    def __init__(self):
+        self.f = None
+        self.path = ""
+        self.lotCnt = 0
+
+    def append(self, data: LotData):
+        if self.f is None:
+            os.makedirs(SPOOL_DIR, exist_ok=True)
+            name = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            self.path = os.path.join(SPOOL_DIR, name + SPOOL_OPEN_EXT)
+            self.f = open(self.path, "ab")
+
+        packed = pack_lot_data(data)
+        self.f.write(spool_record_struct.pack(len(packed), zlib.crc32(packed)))
+        self.f.write(packed)
+        self.f.flush()
+        self.lotCnt += 1
+
+        if self.f.tell() >= SPOOL_SEGMENT_BYTES:
+            self.seal()
+
+    # make the current segment durable and visible to the uploader
+    def seal(self):
+        if self.f is None:
+            return
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.f = None
+        os.replace(self.path, self.path[: -len(SPOOL_OPEN_EXT)] + SPOOL_SEGMENT_EXT)
+
+
+# read the lots in a segment, stopping at the first torn or corrupt record
+def read_spool_segment(path: str) -> List[LotData]:
+    with open(path, "rb") as f:
+        buf = f.read()
+
+    lots = list()
+    offset = 0
+    while offset + spool_record_struct.size <= len(buf):
+        length, crc = spool_record_struct.unpack_from(buf, offset)
+        offset += spool_record_struct.size
+        packed = buf[offset : offset + length]
+        if len(packed) != length or zlib.crc32(packed) != crc:
+            log(bcolors.warning(f"Spool segment {path} is damaged at byte {offset}"))
+            break
+        lots.append(unpack_lot_data(packed)[0])
+        offset += length
+
+    return lots
+
+
+# sealed segments (or quarantined ones with ext=SPOOL_BAD_EXT), oldest first
+def get_spool_segments(ext: str = SPOOL_SEGMENT_EXT) -> List[str]:
+    if not os.path.isdir(SPOOL_DIR):
+        return list()
+    return sorted(
+        os.path.join(SPOOL_DIR, name)
+        for name in os.listdir(SPOOL_DIR)
+        if name.endswith(ext)
+    )
 
-        if lot in lot_layers.keys():
-            lot_layers[lot].append(layer)
-        else:
-            lot_layers[lot]: List[str] = list()
-            lot_layers[lot].append(layer)
+
+# order segments for upload by their most important lot, see schedule_lots
+# unreadable segments go last, uploading them fails and quarantines them
+# also returns the (lotNum, layer) pairs in the segments
+def schedule_segments(segments: List[str]) -> Tuple[List[str], Set[Tuple]]:
+    priorities = dict()
+    lot_layers = set()
+    for segment in segments:
+        lots = read_spool_segment(segment)
+        priorities[segment] = (
+            (False, min(get_lot_priority(lot) for lot in lots)) if lots else (True,)
+        )
+        lot_layers.update((lot.lotNum, lot.layer) for lot in lots)
+    return sorted(segments, key=lambda segment: priorities[segment]), lot_layers
+
+
+# seal segments left open by a run that died while parsing
+def recover_spool():
+    if not os.path.isdir(SPOOL_DIR):
+        return
+    for name in sorted(os.listdir(SPOOL_DIR)):
+        if name.endswith(SPOOL_OPEN_EXT):
+            path = os.path.join(SPOOL_DIR, name)
+            log(bcolors.warning(f"Recovering unsealed spool segment {path}"))
+            os.replace(path, path[: -len(SPOOL_OPEN_EXT)] + SPOOL_SEGMENT_EXT)
+
+
+# the segment has been committed to the database, drop it
+def ack_spool_segment(path: str):
+    os.remove(path)
+
+
+# the database rejected the segment, set it aside so the rest of the spool can drain
+# its lots are not parsed again, rename it back to .seg to retry it
+def quarantine_spool_segment(path: str):
+    os.replace(path, path[: -len(SPOOL_SEGMENT_EXT)] + SPOOL_BAD_EXT)
+
+
+# lot keys normalized for comparison, lot numbers come back from SQL and the
+# parser as both str and int
+def get_lot_key(lotNum, machine: str, layer: str) -> Tuple[str, str, str]:
+    return (str(lotNum).replace("-", ""), machine, layer)
+
+
+# load the lot_data keys into existing_lot_data_keys, from the database when it is
+# up and from the copy cached by the last successful load when it isn't
+def load_existing_lot_keys():
+    log("Fetching existing primary key combinations from database...")
+    strSQL = "SELECT lotNum, machine, layer FROM LTCC_PRO.dspg.lot_data"
+    try:
+        rows = db_pool.run(lambda cnxn: cnxn.cursor().execute(strSQL).fetchall())
+        keys = [(str(row.lotNum).replace("-", ""), row.machine, row.layer) for row in rows]
+
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        tmp_path = LOT_KEYS_CACHE_PATH + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(keys, f)
+        os.replace(tmp_path, LOT_KEYS_CACHE_PATH)
+    except Exception as e:
+        if not os.path.isfile(LOT_KEYS_CACHE_PATH):
+            raise
+        log(bcolors.warning(f"Database unavailable, using cached lot keys: {repr(e)}"))
+        with open(LOT_KEYS_CACHE_PATH, "r") as f:
+            keys = json.load(f)
+
+    existing_lot_data_keys.update(tuple(key) for key in keys)
+
+
+# the rows one spool segment writes, sent with executemany once the whole segment
+# has been checked against the database
+class SegmentUpload:
+    def __init__(self):
+        self.lot_rows: List[Tuple] = list()
+        self.circuit_rows: Dict[Tuple, Tuple] = dict()  # by circuit key
+        self.upgrades: List[Tuple] = list()  # circuit_data keys to delete first
+        self.changes: List[Tuple] = list()  # see finish_batch
+        self.lot_keys: Set[Tuple[str, str, str]] = set()
+        self.lot_layers: Set[Tuple] = set()
+
+
+# add one lot and its circuits to the segment upload
+# a circuit that is already stored is only replaced when it became NonRepairable
+def upload_lot(
+    cursor: pyodbc.Cursor,
+    lot: LotData,
+    existing_circuit_data_keys: CircuitKeyIndex,
+    upload: SegmentUpload,
+):
+    log(f"Uploading lot {lot.lotNum}, layer {lot.layer} to SQL...")
+    upload.lot_keys.add(get_lot_key(lot.lotNum, lot.machine, lot.layer))
+    upload.lot_layers.add((lot.lotNum, lot.layer))
+    upload.lot_rows.append(get_lot_row(lot))
+    upload.changes.append(
+        ("lot_data", "inserted", lot.lotNum, lot.machine, lot.layer, None, None)
+    )
+
+    # one status query per lot for the circuits the index says are stored
+    stored_status = dict()
+    if existing_circuit_data_keys.contains_many(
+        lot.lotNum,
+        lot.layer,
+        [circuit.substrateNum for circuit in lot.circuitData],
+        [circuit.circuitNum for circuit in lot.circuitData],
+    ).any():
+        cursor.execute(
+            "SELECT substrateNum, circuitNum, status FROM LTCC_PRO.dspg.circuit_data WHERE lotNum = ? AND layer = ?",
+            (lot.lotNum, lot.layer),
+        )
+        for row in cursor.fetchall():
+            stored_status[(row.substrateNum, row.circuitNum)] = row.status
+
+    for circuit in lot.circuitData:
+        circuit.lotNum = lot.lotNum
+        circuit_key = (lot.lotNum, circuit.substrateNum, circuit.circuitNum, lot.layer)
+        changeType = "inserted"
+
+        pending = upload.circuit_rows.get(circuit_key)
+        status = stored_status.get((circuit.substrateNum, circuit.circuitNum))
+        if pending is not None:  # another lot in this segment has the circuit
+            if pending[3] == "NonRepairable" or circuit.status != "NonRepairable":
+                continue
+            log(bcolors.okblue(f"Updating {circuit_key}..."))
+            changeType = "upgraded"
+        elif status is not None:  # Have we already processed the circuit?
+            if status == "NonRepairable" or circuit.status != "NonRepairable":
+                continue
+            # circuit is not repairable, remove and update db record
+            log(bcolors.okblue(f"Updating {circuit_key}..."))
+            upload.upgrades.append(circuit_key)
+            changeType = "upgraded"
+
+        upload.circuit_rows[circuit_key] = get_circuit_row(lot, circuit)
+        upload.changes.append(
+            (
+                "circuit_data",
+                changeType,
+                lot.lotNum,
+                None,
+                lot.layer,
+                circuit.substrateNum,
+                circuit.circuitNum,
+            )
+        )
+
+
+# parse new log files into the spool, needs no database if lot keys are cached
+def parse_stage(run_start: datetime):
+    recover_spool()
 
     # skip currently running lot and its sister lot
     current_lots = list()
@@ -414,154 +1277,277 @@ def main():
         current_lots.append(lot)
         current_lots.append(str(int(lot) + 1))
 
-    # Fetch existing primary key combinations from database
-    log("Fetching existing primary key combinations from database...")
-    global existing_lot_data_keys
-    strSQL = "SELECT lotNum, machine, layer FROM LTCC_PRO.dspg.lot_data"
-    cursor.execute(strSQL)
-    for row in cursor.fetchall():
-        lot = row.lotNum
-        # Check for sister lots
-        if "-" in str(lot):
-            oldLotNum = lot
-            num, sister = lot.split("-")
-            lot = int(str(num) + str(sister))
-            log(bcolors.warning(f"Amending sister lot {oldLotNum} -> {lot}"))
+    # skip lots already uploaded, still waiting in the spool or quarantined
+    load_existing_lot_keys()
+    for segment in get_spool_segments() + get_spool_segments(SPOOL_BAD_EXT):
+        for lot in read_spool_segment(segment):
+            existing_lot_data_keys.add(get_lot_key(lot.lotNum, lot.machine, lot.layer))
 
-        existing_lot_data_keys.add((lot, row.machine, row.layer))
+    # walk thru DATA_PATH and get data for each lot, most important files first
+    log("Parsing new log files...")
+    files_to_parse = schedule_files(get_files_to_parse(current_lots))
+    spool = SpoolWriter()
+    parsed_files = 0
+    parsed_rows = 0
+    try:
+        for fp, content in prefetch_files(files_to_parse):
+            # leave the rest for the next run once the budget is spent
+            if over_time_budget(run_start, PARSE_BUDGET_SHARE) or (
+                RUN_ROW_BUDGET is not None and parsed_rows >= RUN_ROW_BUDGET
+            ):
+                log(
+                    bcolors.warning(
+                        f"Run budget reached, leaving {len(files_to_parse) - parsed_files} files for the next run."
+                    )
+                )
+                break
+            parsed_files += 1
 
-    existing_circuit_data_keys = set()
-    strSQL = (
-        "SELECT lotNum, substrateNum, circuitNum, layer FROM LTCC_PRO.dspg.circuit_data"
-    )
-    cursor.execute(strSQL)
-    for row in cursor.fetchall():
-        lot = str(row.lotNum)
-        if "-" in str(lot):
-            oldLotNum = lot
-            num, sister = lot.split("-")
-            lot = str(num) + str(sister)
-            log(bcolors.warning(f"Amending sister lot {oldLotNum} -> {lot}"))
+            if isinstance(content, Exception):
+                log(bcolors.warning(f"Error while reading {fp}: {repr(content)}"))
+                continue
 
-        existing_circuit_data_keys.add(
-            (lot, row.substrateNum, row.circuitNum, row.layer)
-        )
+            try:
+                if fp.endswith(RECORD_EXT):
+                    try:
+                        lot_data = parse_data_from_record(fp, content)
+                    except Exception as e:  # stale or damaged record, use the raw log
+                        log(bcolors.warning(f"Bad parsed record {fp}: {repr(e)}"))
+                        lot_data = parse_data_from_file(fp[: -len(RECORD_EXT)])
+                else:
+                    lot_data = parse_data_from_file(fp, content)
+            except Exception as e:
+                log(bcolors.warning(f"Error while parsing: {repr(e)}"))
+                continue
 
-    # walk thru DATA_PATH and get data for each lot
-    log("Parsing new log files...")
-    all_lots_data = list()
-    for dirpath, dirnames, filenames in os.walk(DATA_PATH):
-        for file in filenames:
-            # Check if lot-layer pair has been parsed already, if so, skip
-            if any(
-                str(lotNum)[:6] in file and layer in file
-                for lotNum, machine, layer in existing_lot_data_keys
-            ) or any(str(lotNum) in file for lotNum in current_lots):
+            if isinstance(lot_data, Exception):
+                log(bcolors.warning(repr(lot_data)))
                 continue
-            else:
-                fp = os.path.join(dirpath, file)
 
-                try:
-                    lot_data = parse_data_from_file(fp)
-                except Exception as e:
-                    log(bcolors.warning(f"Error while parsing: {repr(e)}"))
-                    continue
-
-                all_lots_data.append(lot_data)
-
-    # Sort all_lots_data
-    all_lots_data = sort_by_startDate(all_lots_data)
-
-    # Remove existing lots
-    all_lots_data = list(
-        (
-            lot
-            for lot in all_lots_data
-            if (lot.lotNum, lot.machine, lot.layer) not in existing_lot_data_keys
+            spool.append(lot_data)
+            existing_lot_data_keys.add(
+                get_lot_key(lot_data.lotNum, lot_data.machine, lot_data.layer)
+            )
+            parsed_rows += len(lot_data.circuitData)
+    finally:
+        spool.seal()
+
+    log(f"{spool.lotCnt} lots spooled.")
+
+
+# upload one spool segment in its own transaction, run through db_pool.run so a
+# dropped connection is retried on a fresh one, the rollback makes that safe
+# the in-memory keys are only updated once the segment is committed
+def upload_segment(
+    cnxn: pyodbc.Connection,
+    segment: str,
+    batchId: int,
+    existing_circuit_data_keys: CircuitKeyIndex,
+    uploaded_lot_keys: Set[Tuple[str, str, str]],
+):
+    cursor = cnxn.cursor()
+    cursor.fast_executemany = True
+
+    upload = SegmentUpload()
+    for lot in schedule_lots(read_spool_segment(segment)):
+        lot_key = get_lot_key(lot.lotNum, lot.machine, lot.layer)
+        if lot_key in uploaded_lot_keys or lot_key in upload.lot_keys:
+            log(f"Lot {lot.lotNum}, layer {lot.layer} already uploaded.")
+            continue
+        upload_lot(cursor, lot, existing_circuit_data_keys, upload)
+
+    if upload.lot_rows:
+        cursor.executemany(
+            f"INSERT INTO LTCC_PRO.dspg.lot_data ({LOT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            upload.lot_rows,
         )
-    )
+    if upload.upgrades:
+        cursor.executemany(
+            "DELETE FROM LTCC_PRO.dspg.circuit_data WHERE lotNum = ? AND substrateNum = ? AND circuitNum = ? AND layer = ?",
+            upload.upgrades,
+        )
+    if upload.circuit_rows:
+        cursor.executemany(
+            f"INSERT INTO LTCC_PRO.dspg.circuit_data ({CIRCUIT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            list(upload.circuit_rows.values()),
+        )
+
+    # summaries count the circuit rows as stored, after this segment's upgrades
+    for lot_layer in upload.lot_layers:
+        rebuild_summaries(cursor, "SELECT ? AS lotNum, ? AS layer", lot_layer)
+    finish_batch(cursor, batchId, upload.changes)
+
+    # Commit all changes
+    cnxn.commit()
 
-    if len(all_lots_data) > 0:
-        log(bcolors.okblue(f"{len(all_lots_data)} lots to upload:"))
+    uploaded_lot_keys.update(upload.lot_keys)
+    existing_lot_data_keys.update(upload.lot_keys)
+    for circuit_key in upload.circuit_rows:
+        existing_circuit_data_keys.add(circuit_key)
+
+
+# load what is already in the database so uploads can skip it
+# circuit keys are only loaded for the spooled lot-layers, rather than scanning all
+# of circuit_data on every run
+def load_upload_keys(
+    cnxn: pyodbc.Connection,
+    lot_layers: Set[Tuple],
+) -> Tuple[Set[Tuple[str, str, str]], CircuitKeyIndex]:
+    cursor = cnxn.cursor()
+    ensure_tables(cursor)
+    close_stale_batches(cursor)
+    cnxn.commit()
+
+    # a segment can be uploaded twice if we died between commit and ack
+    uploaded_lot_keys = set()
+    strSQL = "SELECT lotNum, machine, layer FROM LTCC_PRO.dspg.lot_data"
+    cursor.execute(strSQL)
+    for row in cursor.fetchall():
+        uploaded_lot_keys.add(get_lot_key(row.lotNum, row.machine, row.layer))
+
+    return uploaded_lot_keys, CircuitKeyIndex.from_db(cursor, lot_layers)
+
+
+# drain the spool into the database, one transaction per segment, most important
+# segments first
+# a failed segment is rolled back and skipped, and only quarantined once a segment
+# behind it uploads, which shows the failure is the segment's own
+# a database outage or SPOOL_MAX_FAILED_SEGMENTS failures in a row stop the drain
+# and leave the rest spooled for the next run
+def upload_stage(run_start: datetime):
+    segments = get_spool_segments()
+    if len(segments) > 0:
+        log(bcolors.okblue(f"{len(segments)} spool segments to upload:"))
     else:
         log("No new lots found.")
+        return
 
-    for lot in all_lots_data:
-        log(f"Uploading lot {lot.lotNum}, layer {lot.layer} to SQL...")
-        lot_key = (lot.lotNum, lot.machine, lot.layer)
-        existing_lot_data_keys.add(lot_key)
-
-        dbTable = "LTCC_PRO.dspg.lot_data"
-        strSQL = f"INSERT INTO {dbTable} (lotNum, machine, layout, startDate, endDate, inputES, reviewedES, goodES, rejectES, outputES, layer, substrateCnt) VALUES ({lot.lotNum}, '{lot.machine}', '{lot.layout}', '{lot.startDate}', '{lot.endDate}', {lot.inputES}, {lot.reviewedES}, {lot.goodES}, {lot.rejectES}, {lot.outputES}, '{lot.layer}', {lot.substrateCnt})"
-        # log(strSQL)
+    segments, lot_layers = schedule_segments(segments)
+    try:
+        uploaded_lot_keys, existing_circuit_data_keys = db_pool.run(
+            load_upload_keys, lot_layers
+        )
+    except Exception as e:
+        log(bcolors.warning("Database unavailable, segments stay spooled."))
+        log(bcolors.fail(repr(e)))
+        return
+
+    failed = list()  # failed segments not yet known to be bad
+    for i, segment in enumerate(segments):
+        if over_time_budget(run_start):
+            log(
+                bcolors.warning(
+                    f"Run budget reached, leaving {len(segments) - i} spool segments for the next run."
+                )
+            )
+            break
 
+        # a batch that can't be started fails for every segment, treat it as an outage
         try:
-            cursor.execute(strSQL)
-        except:
-            print("Error executing query!")
-
-        if cursor.rowcount != 1:
-            log(bcolors.warning("SQL ERROR!"))
+            batchId = begin_batch("upload")
+        except Exception as e:
+            log(
+                bcolors.warning(
+                    f"Could not start a change batch, leaving {len(segments) - i} spool segments for the next run."
+                )
+            )
+            log(bcolors.fail(repr(e)))
+            break
 
-        for circuit in lot.circuitData:
-            circuit.lotNum = lot.lotNum
-            circuit_key = (
-                circuit.lotNum,
-                circuit.substrateNum,
-                circuit.circuitNum,
-                lot.layer,
+        try:
+            db_pool.run(
+                upload_segment,
+                segment,
+                batchId,
+                existing_circuit_data_keys,
+                uploaded_lot_keys,
             )
-            if (
-                circuit_key in existing_circuit_data_keys
-            ):  # Have we already processed the circuit?
-                # Handle circuit already being in DB
+        except Exception as e:
+            abandon_batch(batchId)
+            if is_transient(e):
+                log(
+                    bcolors.warning(
+                        f"Database unavailable, leaving {len(segments) - i} spool segments for the next run."
+                    )
+                )
+                log(bcolors.fail(repr(e)))
+                break
+            log(bcolors.warning(f"Error with SQL Transaction uploading {segment}!"))
+            log(bcolors.fail(repr(e)))
+            failed.append(segment)
+            if len(failed) >= SPOOL_MAX_FAILED_SEGMENTS:
                 log(
                     bcolors.warning(
-                        f"Circuit {circuit_key} already exists in database. Checking status..."
+                        f"{len(failed)} segments failed in a row, leaving the spool for the next run."
                     )
                 )
+                break
+            continue
 
-                strSQL = f"SELECT status from LTCC_PRO.dspg.circuit_data WHERE lotNum = {circuit.lotNum} AND substrateNum = {circuit.substrateNum} AND circuitNum = {circuit.circuitNum} AND layer = '{lot.layer}'"
-                cursor.execute(strSQL)
-                row = cursor.fetchone()
-                if row:
-                    if (
-                        row.status != "NonRepairable"
-                        and circuit.status == "NonRepairable"
-                    ):  # circuit is not repairable, remove and update db record
-                        strSQL = f"DELETE FROM LTCC_PRO.dspg.circuit_data WHERE lotNum = {circuit.lotNum} AND substrateNum = {circuit.substrateNum} AND circuitNum = {circuit.circuitNum} AND layer = '{lot.layer}'"
-                        cursor.execute(strSQL)
-                        log(bcolors.okblue(f"Updating {circuit_key}..."))
-                    else:  # circuit is NOT not repairable, skip it
-                        continue
-            else:
-                existing_circuit_data_keys.add(circuit_key)
-
-            dbTable = "LTCC_PRO.dspg.circuit_data"
-            stopBit = 1 if circuit.didStop is True else 0
-            strSQL = f"INSERT INTO {dbTable} (lotNum, substrateNum, circuitNum, status, length, breadth, area, didStop, layer) VALUES ({lot.lotNum}, {circuit.substrateNum}, {circuit.circuitNum}, '{circuit.status}', {circuit.length}, {circuit.breadth}, {circuit.area}, {stopBit}, '{lot.layer}')"
-            # log(strSQL)
+        ack_spool_segment(segment)
+        # the segments that failed before this one are bad on their own
+        for bad_segment in failed:
+            log(bcolors.warning(f"Quarantining {bad_segment}."))
+            quarantine_spool_segment(bad_segment)
+        failed.clear()
 
-            try:
-                cursor.execute(strSQL)
-            except:
-                print("Error executing query!")
 
-            if cursor.rowcount != 1:
-                log(bcolors.warning("SQL ERROR!"))
+# Main
+def main(stages: Tuple[str, ...] = ("parse", "upload")):
+    print(bcolors.header("Program started."))
+    print("Please wait...")
 
-    try:
-        # Commit all changes
-        cnxn.commit()
-    except Exception as e:
-        log(bcolors.warning("Error with SQL Transaction!"))
-        log(bcolors.fail(repr(e)))
-    finally:
-        cnxn.close()
+    # Setup
+    run_start = datetime.now()
+    log("Initializing...")
+
+    if "parse" in stages:
+        parse_stage(run_start)
+    if "upload" in stages:
+        upload_stage(run_start)
+
+
+# command line, no arguments runs the scheduled parse
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="DSP Printing AOI log file parser")
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("parse", help="only parse new logs into the spool")
+    subparsers.add_parser("upload", help="only upload spooled lots to SQL")
+
+    backfill_parser = subparsers.add_parser(
+        "backfill", help="re-ingest lots in a date range in parallel"
+    )
+    backfill_parser.add_argument(
+        "--start", type=datetime.fromisoformat, help="first lot start date, YYYY-MM-DD"
+    )
+    backfill_parser.add_argument(
+        "--end", type=datetime.fromisoformat, help="last lot start date, YYYY-MM-DD"
+    )
+    backfill_parser.add_argument("--layer", help="only this layer, e.g. A2")
+    backfill_parser.add_argument("--machine", help="only this machine")
+    backfill_parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="parser processes"
+    )
+
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    freeze_support()  # needed for backfill workers in the pyinstaller exe
+    args = parse_args()
     try:
-        main()
+        if args.command == "backfill":
+            backfill(
+                args.start,
+                args.end + timedelta(days=1) if args.end else None,  # inclusive
+                args.layer,
+                args.machine,
+                args.workers,
+            )
+        elif args.command in ("parse", "upload"):
+            main((args.command,))
+        else:
+            main()
     finally:
         log("Program finished!")
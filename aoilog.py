@@ -0,0 +1,418 @@
+# Log parsing and the parsed record format, shared by aoi-log-parser.py and file-sync.py
+# stdlib only, so file-sync.py can parse on the AOIs without numpy or a database
+
+# Imports
+import json
+import os
+import re
+import struct
+from datetime import datetime
+from typing import *
+
+# Globals
+LOG_FILE = None  # log file path, aoi-log-parser.py sets it in developer mode
+DATE_FORMAT = "%m/%d/%Y"
+RECORD_EXT = ".aoirec"  # parsed record written next to a raw log by file-sync.py
+RECORD_MAGIC = b"AOIR"
+RECORD_VERSION = 1  # bump when parse_log_file output changes
+
+# precompile regular expressions
+layer_prog = re.compile(r"_([A-Z]\d+)_")
+prog = re.compile(r"\[(.*?)\](.*?)(?=\n\[|$)")
+circuit_prog = re.compile(
+    r"ES\s+(\d+)\s+FC(?:\s+(\d+))?\s+Length\s+(\d+\.\d+)\s+Breadth\s+(\d+\.\d+)\s+Area\s+(\d+\.\d+)"
+)
+
+# parsed record layout: magic, version, header length, JSON lot header, circuit rows
+STATUSES = [
+    "No Failure",
+    "NonRepairable",
+    "Repairable",
+    "FalseDefect",
+    "NotReviewed",
+    "Unknown",
+]
+record_header_struct = struct.Struct("<4sHI")
+circuit_struct = struct.Struct("<iiB?ddd")  # substrate, circuit, status, stop, dims
+
+
+# Classes
+class bcolors:
+    HEADER = "\033[95m"
+    OKBLUE = "\033[94m"
+    OKGREEN = "\033[92m"
+    WARNING = "\033[93m"
+    FAIL = "\033[91m"
+    BOLD = "\033[1m"
+    UNDERLINE = "\033[4m"
+    ENDC = "\033[0m"
+
+    # Method that returns a message with the desired color
+    # usage:
+    #    print(bcolor.colored("My colored message", bcolor.OKBLUE))
+    @staticmethod
+    def colored(message, color):
+        return color + message + bcolors.ENDC
+
+    # Method that returns a yellow warning
+    # usage:
+    #   print(bcolors.warning("What you are about to do is potentially dangerous. Continue?"))
+    @staticmethod
+    def warning(message):
+        return bcolors.WARNING + message + bcolors.ENDC
+
+    # Method that returns a red fail
+    # usage:
+    #   print(bcolors.fail("What you did just failed massively. Bummer"))
+    #   or:
+    #   sys.exit(bcolors.fail("Not a valid date"))
+    @staticmethod
+    def fail(message):
+        return bcolors.FAIL + message + bcolors.ENDC
+
+    # Method that returns a green ok
+    # usage:
+    #   print(bcolors.ok("What you did just ok-ed massively. Yay!"))
+    @staticmethod
+    def ok(message):
+        return bcolors.OKGREEN + message + bcolors.ENDC
+
+    # Method that returns a blue ok
+    # usage:
+    #   print(bcolors.okblue("What you did just ok-ed into the blue. Wow!"))
+    @staticmethod
+    def okblue(message):
+        return bcolors.OKBLUE + message + bcolors.ENDC
+
+    # Method that returns a header in some purple-ish color
+    # usage:
+    #   print(bcolors.header("This is great"))
+    @staticmethod
+    def header(message):
+        return bcolors.HEADER + message + bcolors.ENDC
+
+
+# class to hold lot data
+class LotData:
+    def __init__(self):
+        self.lotNum: int = 0
+        self.machine: str = "NULL"
+        self.layout: str = "NA"
+        self.layer: str = "NA"
+        self.startDate: datetime = None
+        self.endDate: datetime = None
+
+        self.substrateCnt: int = 0
+
+        self.inputES: int = 0
+        self.reviewedES: int = 0
+        self.goodES: int = 0
+        self.rejectES: int = 0
+        self.outputES: int = 0
+
+        self.circuitData: List[CircuitData] = list()
+
+    def __repr__(self) -> str:
+        reprStr = ""
+        reprStr += f"lotNum: {self.lotNum}\n"
+        reprStr += f"machine: {self.machine}\n"
+        reprStr += f"layout: {self.layout}\n"
+        reprStr += f"layer: {self.layer}\n"
+        reprStr += f"num substrates: {self.substrateCnt}\n"
+        reprStr += f"num failures: {len(self.circuitData)}\n"
+
+        return reprStr
+
+
+# class to hold circuit data
+class CircuitData:
+    def __init__(self):
+        self.lotNum: int = 0
+        self.substrateNum: int = 0
+        self.circuitNum: int = 0
+        self.status: str = "No Failure"
+        self.didStop: bool = False
+        self.length: int = 0
+        self.breadth: int = 0
+        self.area: int = 0
+
+    def __repr__(self) -> str:
+        reprStr = ""
+        reprStr += f"lotNum: {self.lotNum}\n"
+        reprStr += f"substrateNum: {self.substrateNum}\n"
+        reprStr += f"circuitNum: {self.circuitNum}\n"
+        reprStr += f"status: {self.status}\n"
+        reprStr += f"dimensions: {self.length} x {self.breadth}\n"
+        reprStr += f"area: {self.area}\n"
+
+        return reprStr
+
+
+# Functions
+def log(msg: str):  # simple logger
+    if LOG_FILE:
+        print(f"{datetime.now()}: {msg}")
+        with open(LOG_FILE, "a") as of:
+            print(f"{datetime.now()}: {msg}", file=of)
+    else:
+        print(f"{datetime.now()}: {msg}")
+
+
+# extract time from string
+def extract_time(time_str: str) -> List[int]:
+    # Split the time string into hours, minutes, and AM/PM
+    parts = time_str.split(":")
+    hour_str, minute_str = parts[0], parts[1][:2]
+    am_pm = parts[1][2:].strip().upper()
+
+    # Convert hour to 24-hour format
+    hour = int(hour_str)
+    if am_pm == "PM" and hour != 12:
+        hour += 12
+    elif am_pm == "AM" and hour == 12:
+        hour = 0
+
+    # Extract minute and second
+    minute = int(minute_str)
+    second = 0
+
+    return hour, minute, second
+
+
+# main parsing function
+# loops thru file line by line and extracts data
+# content can be passed in if the file was already read
+def parse_log_file(path: str, content: str = None) -> LotData:
+    if content is not None:
+        log(f"Parsing data from {path}...")
+    # Ensure path exists
+    elif not os.path.isfile(path):
+        return Exception(f"{path} is not a file!")
+    else:
+        log(f"Parsing data from {path}...")
+        content = read_file(path)
+
+    # Initialize
+    data = LotData()
+    substrateNum = 0
+    bak_substrateCnt = 0
+
+    # extract layer from filename
+    layer_match = layer_prog.search(os.path.basename(path))
+    if layer_match:
+        data.layer = layer_match[0][1:3]  # get 'A2' from '_A2_'
+    else:
+        data.layer = "NA"
+
+    for line in content.splitlines():
+        match = prog.search(line)
+        if match:
+            param = match[1].strip()
+            value = match[2].strip()
+
+            if param == "Machine":
+                if value == "BoschDsp - AOI":
+                    data.machine = "NULL"
+                else:
+                    data.machine = value
+            elif param == "Typ":
+                data.layout = value
+            elif param == "ChargenNr":
+                data.lotNum = value
+                # Check for sister lots
+                if "-" in data.lotNum:
+                    oldLotNum = data.lotNum
+                    num, sister = data.lotNum.split("-")
+                    data.lotNum = int(str(num) + str(sister))
+                    log(
+                        bcolors.warning(
+                            f"Amending sister lot {oldLotNum} -> {data.lotNum}"
+                        )
+                    )
+            elif param == "StartDate":
+                data.startDate = datetime.strptime(value, DATE_FORMAT)
+            elif param == "StartTime":
+                hour, minute, second = extract_time(value)
+                data.startDate = data.startDate.replace(
+                    hour=hour, minute=minute, second=second
+                )
+            elif param == "EndDate":
+                data.endDate = datetime.strptime(value, DATE_FORMAT)
+            elif param == "EndTime":
+                hour, minute, second = extract_time(value)
+                data.endDate = data.endDate.replace(
+                    hour=hour, minute=minute, second=second
+                )
+            elif param == "GS-Input":
+                data.substrateCnt = int(value)
+            elif param == "ES-Input":
+                data.inputES = value
+            elif param == "ES-Reviewed":
+                data.reviewedES = value
+            elif param == "ES-Good":
+                data.goodES = value.split()[0]
+            elif param == "Total-rejects":
+                data.rejectES = value
+            elif param == "ES-Output":
+                data.outputES = value
+            elif param == "GS":
+                substrateNum = value.split("A")[0]
+                bak_substrateCnt += 1
+        elif line.startswith("\tES "):  # extract circuit data
+            circuit_data = CircuitData()
+
+            circuit_data.lotNum = data.lotNum
+            circuit_data.substrateNum = substrateNum  # starts at 1!
+
+            circuit_match = circuit_prog.search(line)
+            if circuit_match:
+                circuit_data.circuitNum = circuit_match[1]
+
+                if circuit_match[2] == "1001":
+                    circuit_data.status = "NonRepairable"
+                elif circuit_match[2] == "1002":
+                    circuit_data.status = "Repairable"
+                elif circuit_match[2] == "1003":
+                    circuit_data.status = "FalseDefect"
+                else:
+                    circuit_data.status = "NotReviewed"
+
+                circuit_data.length = circuit_match[3]
+                circuit_data.breadth = circuit_match[4]
+                circuit_data.area = circuit_match[5]
+            else:  # corrupted data on this line
+                circuit_data.circuitNum = -1
+                circuit_data.status = "Unknown"
+                circuit_data.length = -1
+                circuit_data.breadth = -1
+                circuit_data.area = -1
+
+            # Check if circuit caused stop
+            if "Serial" in line and "True" in line:
+                circuit_data.didStop = True
+
+            data.circuitData.append(circuit_data)
+
+            log("Circuit data extracted:" + "\n" + repr(circuit_data))
+        elif line.startswith("\tNo Failure"):
+            # continue  # don't do anything to lines that don't have a failure - reduce lines in DB
+            circuit_data = CircuitData()
+            circuit_data.lotNum = data.lotNum
+            circuit_data.substrateNum = substrateNum
+            circuit_data.circuitNum = 0
+            circuit_data.status = "No Failure"
+
+            log("Circuit data extracted:" + "\n" + repr(circuit_data))
+            # data.circuitData.append(circuit_data)
+            continue
+
+    log("Lot data extracted:" + "\n" + repr(data))
+
+    return data
+
+
+# read the whole text of a file, parsed records are read as bytes
+def read_file(path: str) -> Union[str, bytes]:
+    with open(path, "rb" if path.endswith(RECORD_EXT) else "r") as f:
+        return f.read()
+
+
+# serialize a parsed lot into the compact record format
+def pack_lot_data(data: LotData) -> bytes:
+    header = {
+        "lotNum": data.lotNum,
+        "machine": data.machine,
+        "layout": data.layout,
+        "layer": data.layer,
+        "startDate": data.startDate.isoformat() if data.startDate else None,
+        "endDate": data.endDate.isoformat() if data.endDate else None,
+        "substrateCnt": data.substrateCnt,
+        "inputES": data.inputES,
+        "reviewedES": data.reviewedES,
+        "goodES": data.goodES,
+        "rejectES": data.rejectES,
+        "outputES": data.outputES,
+        "circuitCnt": len(data.circuitData),
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    chunks = [record_header_struct.pack(RECORD_MAGIC, RECORD_VERSION, len(header_bytes))]
+    chunks.append(header_bytes)
+    for circuit in data.circuitData:
+        chunks.append(
+            circuit_struct.pack(
+                int(circuit.substrateNum),
+                int(circuit.circuitNum),
+                STATUSES.index(circuit.status),
+                circuit.didStop,
+                float(circuit.length),
+                float(circuit.breadth),
+                float(circuit.area),
+            )
+        )
+    return b"".join(chunks)
+
+
+# rebuild a LotData from a packed record, returns the number of bytes consumed too
+def unpack_lot_data(buf: bytes, offset: int = 0) -> Tuple[LotData, int]:
+    magic, version, header_len = record_header_struct.unpack_from(buf, offset)
+    if magic != RECORD_MAGIC:
+        raise ValueError("Not a parsed record!")
+    if version != RECORD_VERSION:
+        raise ValueError(f"Parsed record version {version} != {RECORD_VERSION}")
+    offset += record_header_struct.size
+
+    header = json.loads(buf[offset : offset + header_len].decode("utf-8"))
+    offset += header_len
+
+    data = LotData()
+    for field in (
+        "lotNum",
+        "machine",
+        "layout",
+        "layer",
+        "substrateCnt",
+        "inputES",
+        "reviewedES",
+        "goodES",
+        "rejectES",
+        "outputES",
+    ):
+        setattr(data, field, header[field])
+    if header["startDate"]:
+        data.startDate = datetime.fromisoformat(header["startDate"])
+    if header["endDate"]:
+        data.endDate = datetime.fromisoformat(header["endDate"])
+
+    for _ in range(header["circuitCnt"]):
+        (
+            substrateNum,
+            circuitNum,
+            status,
+            didStop,
+            length,
+            breadth,
+            area,
+        ) = circuit_struct.unpack_from(buf, offset)
+        offset += circuit_struct.size
+
+        circuit_data = CircuitData()
+        circuit_data.lotNum = data.lotNum
+        circuit_data.substrateNum = substrateNum
+        circuit_data.circuitNum = circuitNum
+        circuit_data.status = STATUSES[status]
+        circuit_data.didStop = didStop
+        circuit_data.length = length
+        circuit_data.breadth = breadth
+        circuit_data.area = area
+        data.circuitData.append(circuit_data)
+
+    return data, offset
+
+
+# write a parsed record next to a raw log, atomically so readers never see half a file
+def write_parsed_record(path: str, data: LotData):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(pack_lot_data(data))
+    os.replace(tmp_path, path)
@@ -0,0 +1,174 @@
+# Shared SQL Server connection pool for the parser, file-sync and dbtest scripts
+
+# Imports
+import atexit
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+from typing import *
+
+import pyodbc
+
+# Globals
+# SQLSTATEs worth retrying: link failures, login/query timeouts, deadlocks
+TRANSIENT_SQLSTATES = {
+    "08001",  # unable to connect
+    "08004",  # server rejected the connection
+    "08007",  # connection failure during transaction
+    "08S01",  # communication link failure
+    "HYT00",  # timeout expired
+    "HYT01",  # connection timeout expired
+    "40001",  # deadlock victim
+}
+
+
+# Methods
+def is_transient(e: BaseException) -> bool:  # is this error worth a retry?
+    # pandas wraps driver errors, so follow the cause chain
+    while e is not None:
+        if (
+            isinstance(e, pyodbc.Error)
+            and len(e.args) > 0
+            and e.args[0] in TRANSIENT_SQLSTATES
+        ):
+            return True
+        e = e.__cause__
+    return False
+
+
+def build_connection_string(
+    server: str, database: str, username: str, password: str
+) -> str:
+    driver = "{ODBC Driver 17 for SQL Server}"
+
+    return (
+        f"DRIVER={driver};"
+        f"SERVER={server};"
+        f"DATABASE={database};"
+        f"UID={username};"
+        f"PWD={password}"
+    )
+
+
+# Classes
+# keeps idle connections around for reuse, checks them before handing them out
+# and retries transient failures with exponential backoff
+# every pool is closed at interpreter exit
+class ConnectionPool:
+    def __init__(
+        self,
+        connection_string: str,
+        max_idle: int = 4,  # idle connections kept open
+        retries: int = 3,  # attempts after the first one
+        backoff: float = 0.5,  # seconds, doubled on each retry
+        health_check_seconds: float = 30,  # ping connections idle longer than this
+        login_timeout: int = 15,
+        log: Callable[[str], None] = print,  # where retry notices go
+    ):
+        self.connection_string = connection_string
+        self.max_idle = max_idle
+        self.retries = retries
+        self.backoff = backoff
+        self.health_check_seconds = health_check_seconds
+        self.login_timeout = login_timeout
+        self.log = log
+
+        self._idle: List[Tuple[pyodbc.Connection, datetime]] = list()
+        self._lock = Lock()
+        self._closed = False
+
+        atexit.register(self.close_all)
+
+    # call fn, retrying transient errors with exponential backoff
+    def _with_retry(self, fn: Callable, *args, **kwargs):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not is_transient(e) or attempt == self.retries:
+                    raise
+                self.log(f"Transient SQL error, retrying in {delay:.1f}s: {repr(e)}")
+                time.sleep(delay)
+                delay *= 2
+
+    def _connect(self) -> pyodbc.Connection:
+        return pyodbc.connect(self.connection_string, timeout=self.login_timeout)
+
+    @staticmethod
+    def _is_healthy(cnxn: pyodbc.Connection) -> bool:
+        try:
+            cnxn.cursor().execute("SELECT 1").fetchone()
+            return True
+        except pyodbc.Error:
+            return False
+
+    @staticmethod
+    def _close(cnxn: pyodbc.Connection):
+        try:
+            cnxn.close()
+        except pyodbc.Error:
+            pass
+
+    # get a connection, reusing an idle one if it still works
+    # retry=False makes a single connect attempt, for callers that retry themselves
+    def acquire(self, retry: bool = True) -> pyodbc.Connection:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                cnxn, released = self._idle.pop()  # most recently used first
+
+            idle_seconds = (datetime.now() - released).total_seconds()
+            if idle_seconds < self.health_check_seconds or self._is_healthy(cnxn):
+                return cnxn
+            self._close(cnxn)
+
+        return self._with_retry(self._connect) if retry else self._connect()
+
+    # hand a connection back, uncommitted work is rolled back
+    def release(self, cnxn: pyodbc.Connection, broken: bool = False):
+        if not broken:
+            try:
+                cnxn.rollback()
+            except pyodbc.Error:
+                broken = True
+
+        with self._lock:
+            if not broken and not self._closed and len(self._idle) < self.max_idle:
+                self._idle.append((cnxn, datetime.now()))
+                return
+        self._close(cnxn)
+
+    # usage:
+    #   with pool.connection() as cnxn:
+    #       cnxn.cursor().execute(...)
+    #       cnxn.commit()
+    @contextmanager
+    def connection(self, retry: bool = True) -> Generator[pyodbc.Connection, None, None]:
+        cnxn = self.acquire(retry)
+        try:
+            yield cnxn
+        except BaseException as e:
+            self.release(cnxn, broken=is_transient(e))
+            raise
+        else:
+            self.release(cnxn)
+
+    # run fn(cnxn, *args) on a pooled connection, retrying the whole call on
+    # transient errors, fn must be safe to repeat
+    # connecting is part of each attempt, so a dead server costs retries + 1 connects
+    def run(self, fn: Callable, *args):
+        def attempt():
+            with self.connection(retry=False) as cnxn:
+                return fn(cnxn, *args)
+
+        return self._with_retry(attempt)
+
+    def close_all(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, list()
+        for cnxn, _ in idle:
+            self._close(cnxn)
@@ -1,34 +1,17 @@
-import pyodbc
 from tabulate import tabulate
 from time import sleep
 import pandas as pd
 from datetime import datetime, timedelta
 from typing import *
 
-THRESHOLD_SECONDS = 24 * 3600
-
-def init_db() -> pyodbc.Connection:  
-    server = r"secret"
-    database = "secret"
-    username = "secret"
-    password = "secret"
-    driver = "{ODBC Driver 17 for SQL Server}"
+from dbpool import ConnectionPool, build_connection_string
 
-    connection_string = (
-        f"DRIVER={driver};"
-        f"SERVER={server};"
-        f"DATABASE={database};"
-        f"UID={username};"
-        f"PWD={password}"
-    )
-    
-    return pyodbc.connect(connection_string)
+THRESHOLD_SECONDS = 24 * 3600
+db_pool = ConnectionPool(build_connection_string("secret", "secret", "secret", "secret"))
 
 def get_printed_lots() -> List[str]:
     printed_lots = list()
     
-    cnxn = init_db()
-    
     strSQL = """
         SELECT
             p.DSPGLotNumber,
@@ -43,7 +26,7 @@ def get_printed_lots() -> List[str]:
             ON l.LayoutId = lo.ID
     """
 
-    data = pd.read_sql_query(strSQL, cnxn)
+    data = db_pool.run(lambda cnxn: pd.read_sql_query(strSQL, cnxn))
 
     return data
 
@@ -60,5 +43,6 @@ def get_incomplete_lots(data: pd.DataFrame) -> pd.DataFrame:
     
     return incomplete_lots[['DSPGLotNumber', 'SetupDate', 'PrintDate', 'Layout', 'Layer']]
 
-print(tabulate(get_printed_lots()))
-print(tabulate(get_incomplete_lots(get_printed_lots())))
\ No newline at end of file
+printed_lots = get_printed_lots()
+print(tabulate(printed_lots))
+print(tabulate(get_incomplete_lots(printed_lots)))
\ No newline at end of file
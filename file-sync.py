@@ -10,9 +10,11 @@ from time import sleep
 from typing import *
 import warnings
 
-import pyodbc
 import pandas as pd
 
+import aoilog
+from dbpool import ConnectionPool, build_connection_string
+
 # Globals
 
 LOCAL_FOLDER = r"D:\BatchLogs"
@@ -21,24 +23,20 @@ SERVER_FOLDER = r"\\10.225.43.45\prod-critical\LTCC\DSP\DSP_Print\BatchLogs"
 SM_INI_PATH = r"\\10.225.43.45\prod-critical\LTCC\DSP\DSP_Print\dsp_print_sdd.ini"
 TD_HRS = 1  # exclude all files created within x hours
 THRESHOLD_SECONDS = 24 * 3600 # if no print date, exclude until over x sec old
+db_pool = ConnectionPool(build_connection_string(r"secret", "secret", "dspuser", "dspus3r"))
+EDGE_PARSE = False  # parse logs here and ship a parsed record next to each raw log
 
 # Methods
-def init_db() -> pyodbc.Connection:  
-    server = r"secret"
-    database = "secret"
-    username = "dspuser"
-    password = "dspus3r"
-    driver = "{ODBC Driver 17 for SQL Server}"
-
-    connection_string = (
-        f"DRIVER={driver};"
-        f"SERVER={server};"
-        f"DATABASE={database};"
-        f"UID={username};"
-        f"PWD={password}"
-    )
-    
-    return pyodbc.connect(connection_string)
+def pre_parse_log(filepath: str, record_path: str) -> bool:  # same parse routine as aoi-log-parser.py
+    # local logs are copied on every run, skip the parse if the server has a record newer than the log
+    if os.path.exists(record_path) and os.stat(record_path).st_mtime >= os.stat(filepath).st_mtime:
+        return False
+
+    lot = aoilog.parse_log_file(filepath)
+    if isinstance(lot, Exception):
+        raise lot
+    aoilog.write_parsed_record(record_path, lot)
+    return True
 
 
 def get_all_filenames(
@@ -67,8 +65,6 @@ def get_running_lots() -> List[str]:
     return running_lots
 
 def get_printed_lots() -> List[str]:    
-    cnxn = init_db()
-    
     strSQL = """
         SELECT
             p.DSPGLotNumber,
@@ -84,7 +80,7 @@ def get_printed_lots() -> List[str]:
     """
 
     warnings.filterwarnings("ignore", message="pandas only supports SQLAlchemy connectable")
-    data = pd.read_sql_query(strSQL, cnxn)
+    data = db_pool.run(lambda cnxn: pd.read_sql_query(strSQL, cnxn))
 
     return data
 
@@ -144,6 +140,15 @@ def main():
 
         if not os.path.exists(os.path.join(SERVER_FOLDER, parent_folder)):
             os.makedirs(os.path.join(SERVER_FOLDER, parent_folder))
+
+        # record goes first so the central parser never sees the raw log without it
+        if EDGE_PARSE:
+            try:
+                if pre_parse_log(filepath, new_path + aoilog.RECORD_EXT):
+                    print(f"pre-parsed {filename}")
+            except Exception as e:
+                print(f"could not pre-parse {filename}: {repr(e)}")
+
         shutil.copy(filepath, new_path)
         print(f"copied {filename}")
 